@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Registry scale benchmark for the rk kernelspec commands
+
+For every size, a synthetic kernels dict with that many kernels is
+generated, and ``rk install-all``, ``rk list``, ``rk install``, ``rk
+uninstall`` and ``rk uninstall-all`` run against a temporary kernels
+location and cache, so no root is needed and the real ones are left
+alone. ``rk install`` and ``rk uninstall`` take a tenth of the kernels.
+
+Every measurement is a fresh interpreter, like a real rk run, which
+records for the command itself:
+
+* wall time,
+* file operations: Python audit events (open, listdir, rename, link,
+  remove, rmtree...), Python 3.8+,
+* read and write syscalls and bytes, from /proc/self/io (Linux),
+* peak memory (maximum resident set size) of the process,
+
+and, with ``--strace``, all syscalls of the process, counted by strace.
+The median of the runs is reported. Results are saved as JSON with the git
+commit, so runs of two commits can be compared::
+
+    $ python benchmarks/bench_cli.py --json before.json
+    $ git checkout my-branch
+    $ python benchmarks/bench_cli.py --json after.json --compare before.json
+
+Usage::
+
+    $ python benchmarks/bench_cli.py
+    $ python benchmarks/bench_cli.py --sizes 10,1000 --runs 5
+
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from json import dump, dumps, load
+from os.path import abspath, dirname, join
+
+try:
+    from time import perf_counter as clock
+except ImportError: # Python 2
+    from time import time as clock
+
+root = abspath(join(dirname(__file__), ".."))
+
+# Name, rk arguments, state of kernels location before: "empty", "all" (all
+# kernels installed) or "list" (empty, but the registry cache is built)
+commands = [
+    ("install-all", ["install-all", "--yes"], "empty"),
+    ("list (cold cache)", ["list"], "empty"),
+    ("list", ["list"], "list"),
+    ("install", ["install", "--yes", "{tenth}"], "all"),
+    ("uninstall", ["uninstall", "{tenth}"], "all"),
+    ("uninstall-all", ["uninstall-all"], "all"),
+]
+
+# Audit events counted as file operations
+file_events = ("open", "os.chmod", "os.link", "os.listdir", "os.mkdir",
+               "os.remove", "os.rename", "os.rmdir", "os.scandir",
+               "os.symlink", "os.truncate", "os.utime", "shutil.copyfile",
+               "shutil.rmtree")
+
+def child(spec_path):
+    """Run one rk command in this process, write its measurements"""
+
+    import resource
+
+    with open(spec_path) as f:
+        spec = load(f)
+    sys.path.insert(0, root)
+    counts = {}
+
+    def audit(event, args):
+        if event in file_events:
+            counts[event] = counts.get(event, 0) + 1
+
+    from rk import rk
+
+    rk.config["kernels_location"] = spec["kernels_location"]
+    rk.config["config_kernels_rel_path"] = spec["kernels_json"] # Absolute
+    rk.config["rk_cache_location"] = spec["cache_location"]
+    argv = ["rk"]
+    for arg in spec["argv"]:
+        if arg == "{tenth}":
+            argv.extend(spec["tenth"])
+        else:
+            argv.append(arg)
+    sys.argv = argv
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    io_before = proc_io()
+    if hasattr(sys, "addaudithook"):
+        sys.addaudithook(audit)
+    start = clock()
+    try:
+        rk.main()
+    except SystemExit:
+        pass
+    wall = clock() - start
+    counts = dict(counts) # Before the hook sees more
+    io_after = proc_io()
+    sys.stdout = stdout
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        maxrss *= 1024 # KiB
+    result = {"wall_s": wall, "peak_rss_mib": maxrss / 1048576.0}
+    if hasattr(sys, "addaudithook"):
+        result["file_ops"] = sum(counts.values())
+        result["file_ops_by_event"] = counts
+    if io_before and io_after:
+        for key in ("syscr", "syscw", "rchar", "wchar"):
+            result[key] = io_after[key] - io_before[key]
+    with open(spec["result_path"], 'w') as f:
+        dump(result, f)
+
+def proc_io():
+    """Return the I/O counters of this process, or None"""
+
+    try:
+        with open("/proc/self/io") as f:
+            return dict((k, int(v)) for k, v in
+                        (line.split(':') for line in f if ':' in line))
+    except (IOError, OSError, ValueError):
+        return None
+
+def make_kernels_json(path, size):
+    """Write a synthetic kernels dict with size kernels over 100 hosts"""
+
+    kernels = {}
+    for i in range(size):
+        kernels["kernel%06i" % i] = {
+                "display_name": "Kernel %i" % i,
+                "interpreter": "python3" if i % 3 else "python2",
+                "language": "python",
+                "remote_host": "user@host%02i.example.com" % (i % 100)}
+    with open(path, 'w') as f:
+        dump(kernels, f, indent=1, sort_keys=True)
+    return sorted(kernels)
+
+def run_rk(work, argv, tenth, env, strace=False):
+    """Run rk with argv in a fresh interpreter, return the measurements"""
+
+    spec_path = join(work, "spec.json")
+    result_path = join(work, "result.json")
+    with open(spec_path, 'w') as f:
+        dump({"argv": argv, "tenth": tenth,
+              "kernels_location": join(work, "kernels"),
+              "kernels_json": join(work, "kernels.json"),
+              "cache_location": join(work, "cache"),
+              "result_path": result_path}, f)
+    command = [sys.executable, abspath(__file__), "--child", spec_path]
+    strace_path = join(work, "strace.txt")
+    if strace:
+        command = ["strace", "-f", "-c", "-o", strace_path] + command
+    start = clock()
+    subprocess.check_call(command, env=env)
+    process = clock() - start
+    with open(result_path) as f:
+        result = load(f)
+    result["process_s"] = process
+    if strace:
+        result["syscalls"] = strace_total(strace_path)
+    return result
+
+def strace_total(path):
+    """Return the total calls of a strace -c summary"""
+
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if fields and fields[-1] == "total":
+                return int(fields[2] if len(fields) > 4 else fields[-2])
+    return None
+
+def prepare(work, state, tenth, env):
+    """Bring the temporary kernels location and cache to state"""
+
+    for name in ("kernels", "cache"):
+        shutil.rmtree(join(work, name), ignore_errors=True)
+    # Not removed if the trash of an earlier run is being emptied meanwhile
+    if not os.path.isdir(join(work, "kernels")):
+        os.makedirs(join(work, "kernels"))
+    if state == "all":
+        run_rk(work, ["install-all", "--yes"], tenth, env)
+    elif state == "list":
+        run_rk(work, ["list"], tenth, env)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def measure(size, runs, env, strace):
+    """Return {command name: median measurements} for a registry size"""
+
+    work = tempfile.mkdtemp(prefix="rk-bench-cli-")
+    try:
+        names = make_kernels_json(join(work, "kernels.json"), size)
+        tenth = names[::10]
+        results = {}
+        for name, argv, state in commands:
+            samples = []
+            for i in range(runs):
+                prepare(work, state, tenth, env)
+                samples.append(run_rk(work, argv, tenth, env, strace))
+            results[name] = dict((key, median([s[key] for s in samples]))
+                                 for key in samples[0]
+                                 if key != "file_ops_by_event")
+            if "file_ops_by_event" in samples[-1]:
+                results[name]["file_ops_by_event"] = \
+                        samples[-1]["file_ops_by_event"]
+        return results
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+def git_commit():
+    """Return the commit of the tree, "+dirty" if it has changes, or None"""
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=root, stderr=subprocess.STDOUT).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain",
+                "--untracked-files=no"], cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+dirty" if dirty else "")
+
+def print_row(name, result, baseline=None):
+    line = "  %-18s %9.1f ms %9s ops %9s syscr %9s syscw %8.1f MiB" % (
+            name, result["wall_s"] * 1e3,
+            result.get("file_ops", "-"), result.get("syscr", "-"),
+            result.get("syscw", "-"), result["peak_rss_mib"])
+    if "syscalls" in result:
+        line += " %9s syscalls" % result["syscalls"]
+    if baseline and baseline.get("wall_s"):
+        line += "   x%.2f" % (result["wall_s"] / baseline["wall_s"])
+    print(line)
+
+def main():
+    """Main function"""
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        child(sys.argv[2])
+        return
+    parser = ArgumentParser(description="rk kernelspec commands benchmark")
+    parser.add_argument("--sizes", default="10,100,1000,10000,50000",
+                        help="kernels dict sizes, separated by commas "
+                             "(default: 10,100,1000,10000,50000)")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="runs per command and size (default: 3)")
+    parser.add_argument("--strace", action="store_true",
+                        help="also count all syscalls with strace")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write results as JSON to PATH")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="show wall time ratios against a JSON of an "
+                             "earlier run")
+    args = parser.parse_args()
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    if args.strace and not any(os.access(join(path, "strace"), os.X_OK)
+                               for path in env["PATH"].split(os.pathsep)):
+        parser.error("strace not found")
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = load(f)["results"]
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        print("%i kernels:" % size)
+        results[str(size)] = measure(size, args.runs, env, args.strace)
+        for name, argv, state in commands:
+            print_row(name, results[str(size)][name],
+                      baseline.get(str(size), {}).get(name))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(dumps({"commit": git_commit(),
+                           "python": sys.version.split()[0],
+                           "platform": sys.platform, "runs": args.runs,
+                           "results": results}, indent=1, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
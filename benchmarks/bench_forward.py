@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput and latency benchmark for the rk.ssh port forwarding
+
+An in-process paramiko SSH server on localhost stands in for a remote host,
+and an echo server stands in for a kernel port, so no real remote host is
+needed. Both rk.ssh.forward.forward_tunnel (in a thread, over one transport)
+and rk.ssh.paramiko_multi_tunnel (in a subprocess, like rkscript) are measured.
+
+Usage::
+
+    $ python benchmarks/bench_forward.py
+    $ python benchmarks/bench_forward.py --size 256 --json results.json
+
+Compare SSH transport settings, like the "ssh" dict of a kernel, on
+compressible JSON messages instead of random bytes::
+
+    $ python benchmarks/bench_forward.py --payload json --compression yes
+    $ python benchmarks/bench_forward.py --ciphers aes128-gcm@openssh.com
+
+"""
+
+from __future__ import print_function
+
+import socket
+import sys
+import threading
+from argparse import ArgumentParser
+from json import dumps
+from os import urandom
+from os.path import abspath, dirname, join
+from time import sleep, time
+
+import paramiko
+
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+
+from rk.ssh import paramiko_multi_tunnel
+from rk.ssh.forward import forward_tunnel
+from rk.ssh.tunnel import _algorithm_options, select_random_ports
+
+try:
+    from time import perf_counter as clock
+except ImportError: # Python 2
+    clock = time
+
+username = "bench"
+password = "bench"
+payload_kind = "random" # Or "json", set by --payload
+
+class Server(paramiko.ServerInterface):
+    """SSH server that only allows direct-tcpip channels"""
+
+    def __init__(self):
+        self.destinations = {} # Channel ID: (host, port)
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "direct-tcpip":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+def copy(source, destination, chunk_size=65536):
+    """Copy bytes from source to destination until EOF"""
+
+    try:
+        while True:
+            data = source.recv(chunk_size)
+            if not data:
+                break
+            destination.sendall(data)
+    except (EOFError, socket.error):
+        pass
+    finally:
+        destination.close()
+
+def start_thread(target, *args):
+    """Start a daemon thread"""
+
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def listen():
+    """Return a listening socket on a random localhost port"""
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    return listener
+
+def start_echo_server():
+    """Start an echo server, return its port"""
+
+    def serve(listener):
+        while True:
+            conn, _ = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            start_thread(copy, conn, conn)
+
+    listener = listen()
+    start_thread(serve, listener)
+    return listener.getsockname()[1]
+
+def start_ssh_server():
+    """Start the in-process SSH server, return its port"""
+
+    host_key = paramiko.RSAKey.generate(2048)
+
+    def serve_transport(conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.use_compression(True) # Allow it, clients choose
+        server = Server()
+        transport.start_server(server=server)
+        while transport.is_active():
+            chan = transport.accept(1)
+            if chan is None:
+                continue
+            destination = socket.create_connection(
+                    server.destinations.pop(chan.get_id()))
+            destination.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            start_thread(copy, chan, destination)
+            start_thread(copy, destination, chan)
+
+    def serve(listener):
+        while True:
+            conn, _ = listener.accept()
+            start_thread(serve_transport, conn)
+
+    listener = listen()
+    start_thread(serve, listener)
+    return listener.getsockname()[1]
+
+def connect(port, timeout=30):
+    """Connect to a local forwarded port, waiting for its listener"""
+
+    deadline = time() + timeout
+    while True:
+        try:
+            conn = socket.create_connection(("127.0.0.1", port))
+        except socket.error:
+            if time() > deadline:
+                raise
+            sleep(0.01)
+        else:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return conn
+
+def recv_exactly(conn, size):
+    """Receive exactly size bytes"""
+
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = conn.recv_into(view[received:])
+        if n == 0:
+            raise EOFError("connection closed after %i bytes" % received)
+        received += n
+    return data
+
+def make_payload(size):
+    """Return size random bytes, or size bytes of iopub-like JSON messages"""
+
+    if payload_kind == "random":
+        return urandom(size)
+    message = dumps({"header": {"msg_type": "stream", "version": "5.0"},
+                     "content": {"name": "stdout",
+                                 "text": "%s\n" % list(range(20))}})
+    message = message.encode("ascii")
+    return (message * (size // len(message) + 1))[:size]
+
+def bulk(port, size):
+    """Echo size bytes through the tunnel, return seconds"""
+
+    conn = connect(port)
+    payload = make_payload(size)
+    result = []
+    start = clock()
+    reader = start_thread(lambda: result.append(recv_exactly(conn, size)))
+    conn.sendall(payload)
+    reader.join()
+    elapsed = clock() - start
+    conn.close()
+    if bytes(result[0]) != payload:
+        raise RuntimeError("corrupted data")
+    return elapsed
+
+def round_trips(port, count, size):
+    """Return sorted round-trip times of count small messages"""
+
+    conn = connect(port)
+    payload = make_payload(size)
+    times = []
+    for i in range(count):
+        start = clock()
+        conn.sendall(payload)
+        recv_exactly(conn, size)
+        times.append(clock() - start)
+    conn.close()
+    times.sort()
+    return times
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def setup_time(port, count):
+    """Return median time from connect() to the first echoed byte"""
+
+    times = []
+    for i in range(count):
+        start = clock()
+        conn = connect(port)
+        conn.sendall(b"x")
+        recv_exactly(conn, 1)
+        times.append(clock() - start)
+        conn.close()
+    times.sort()
+    return percentile(times, 50)
+
+def concurrent(port, connections, size):
+    """Return aggregate MB/s of connections parallel bulk transfers"""
+
+    start = clock()
+    threads = [start_thread(bulk, port, size) for i in range(connections)]
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+    return connections * size / elapsed / 1e6
+
+def run(name, port, args):
+    """Run every measurement against a forwarded port"""
+
+    size = args.size * 1024 * 1024
+    results = {"backend": name}
+    # Warm up the tunnel
+    bulk(port, 65536)
+    results["bulk_MBps"] = size / bulk(port, size) / 1e6
+    times = round_trips(port, args.messages, args.message_size)
+    results["rtt_p50_ms"] = percentile(times, 50) * 1e3
+    results["rtt_p99_ms"] = percentile(times, 99) * 1e3
+    results["setup_ms"] = setup_time(port, args.setups) * 1e3
+    for connections in args.concurrency:
+        key = "concurrent_%i_MBps" % connections
+        results[key] = concurrent(port, connections,
+                                  size // max(connections, 1))
+    return results
+
+def bench_forward_tunnel(ssh_port, echo_port, args):
+    """Benchmark forward_tunnel over an in-process transport"""
+
+    options = _algorithm_options(args.ciphers, args.macs, args.compression)
+    start = clock()
+    transport = paramiko.Transport(("127.0.0.1", ssh_port),
+            disabled_algorithms=options.get("disabled_algorithms"))
+    transport.use_compression(options.get("compress", False))
+    transport.connect(username=username, password=password)
+    handshake = clock() - start
+    print("forward_tunnel: cipher %s, mac %s, compression %s" %
+          (transport.local_cipher, transport.local_mac,
+           transport.local_compression))
+    lport = select_random_ports(1)[0]
+    start_thread(forward_tunnel, lport, "127.0.0.1", echo_port, transport)
+    results = run("forward_tunnel", lport, args)
+    results["handshake_ms"] = handshake * 1e3
+    transport.close()
+    return results
+
+def bench_paramiko_tunnel(ssh_port, echo_port, args):
+    """Benchmark paramiko_multi_tunnel, the way rkscript starts it"""
+
+    lport = select_random_ports(1)[0]
+    server = "%s@127.0.0.1:%i" % (username, ssh_port)
+    start = clock()
+    process = paramiko_multi_tunnel([(lport, echo_port)], server,
+                                    password=password, ciphers=args.ciphers,
+                                    macs=args.macs,
+                                    compression=args.compression)
+    # The local port is bound before the SSH handshake, so wait for the
+    # first byte echoed through the tunnel, not only for the connect
+    conn = connect(lport)
+    conn.sendall(b"x")
+    recv_exactly(conn, 1)
+    handshake = clock() - start
+    conn.close()
+    results = run("paramiko_tunnel", lport, args)
+    results["handshake_ms"] = handshake * 1e3
+    process.terminate()
+    return results
+
+def print_results(results):
+    """Print results as a table"""
+
+    keys = sorted(set(k for r in results for k in r if k != "backend"))
+    print("%-22s" % "" + "".join("%18s" % r["backend"] for r in results))
+    for key in keys:
+        print("%-22s" % key + "".join("%18.2f" % r[key] for r in results))
+
+def main():
+    """Main function"""
+
+    parser = ArgumentParser(description="rk.ssh forwarding benchmark")
+    parser.add_argument("--size", type=int, default=64,
+                        help="bulk transfer size, MiB (default: 64)")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="round trips for the latency test")
+    parser.add_argument("--message-size", type=int, default=64,
+                        help="bytes per latency test message")
+    parser.add_argument("--setups", type=int, default=50,
+                        help="connections for the setup time test")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        help="comma separated parallel connection counts")
+    parser.add_argument("--backend", choices=["all", "forward_tunnel",
+                                              "paramiko_tunnel"],
+                        default="all")
+    parser.add_argument("--payload", choices=["random", "json"],
+                        default="random",
+                        help="random bytes, or compressible JSON messages")
+    parser.add_argument("--ciphers", metavar="CIPHER,...",
+                        help="SSH ciphers to allow")
+    parser.add_argument("--macs", metavar="MAC,...",
+                        help="SSH MACs to allow")
+    parser.add_argument("--compression", choices=["yes", "no"],
+                        help="turn SSH compression on or off")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write results as JSON to PATH")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(',')]
+    for key in ("ciphers", "macs"):
+        if getattr(args, key):
+            setattr(args, key, getattr(args, key).split(','))
+    if args.compression:
+        args.compression = args.compression == "yes"
+    global payload_kind
+    payload_kind = args.payload
+    ssh_port = start_ssh_server()
+    echo_port = start_echo_server()
+    results = []
+    if args.backend in ("all", "forward_tunnel"):
+        results.append(bench_forward_tunnel(ssh_port, echo_port, args))
+    if args.backend in ("all", "paramiko_tunnel"):
+        results.append(bench_paramiko_tunnel(ssh_port, echo_port, args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(dumps(results, indent=1, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
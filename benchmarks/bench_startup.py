@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Startup time benchmark for the rk and rkscript entry points
+
+Every measurement is a fresh interpreter, like a real rk or rkscript run.
+The first run of each command is a warm up (bytecode and rk catalog
+compilation) and is not counted.
+
+Usage::
+
+    $ python benchmarks/bench_startup.py
+    $ python benchmarks/bench_startup.py --runs 50 --json results.json
+
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from json import dumps
+from os.path import abspath, dirname, join
+
+try:
+    from time import perf_counter as clock
+except ImportError: # Python 2
+    from time import time as clock
+
+root = abspath(join(dirname(__file__), ".."))
+rk_main = "import sys; sys.argv = ['rk'] + sys.argv[1:]; " \
+          "from rk.rk import main; main()"
+
+commands = [
+    ("python", ["-c", "pass"]),
+    ("import rk.rk", ["-c", "import rk.rk"]),
+    ("rk --help", ["-c", rk_main, "--help"]),
+    ("rk list", ["-c", rk_main, "list"]),
+    ("rkscript (wrong arguments)", [join(root, "scripts", "rkscript")]),
+]
+
+def run(arguments, env):
+    """Run python with arguments, return seconds"""
+
+    start = clock()
+    subprocess.call([sys.executable] + arguments, env=env,
+                    stdout=open(os.devnull, 'w'),
+                    stderr=subprocess.STDOUT)
+    return clock() - start
+
+def import_times(env, top):
+    """Return the top slowest imports of rk.rk from -X importtime"""
+
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c",
+                                "import rk.rk"], env=env,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    output = process.communicate()[1]
+    times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split('|')
+        try:
+            times.append((int(fields[1]), fields[2].rstrip()))
+        except ValueError:
+            continue
+    times.sort(reverse=True)
+    return times[:top]
+
+def main():
+    """Main function"""
+
+    parser = ArgumentParser(description="rk startup time benchmark")
+    parser.add_argument("--runs", type=int, default=20,
+                        help="runs per command (default: 20)")
+    parser.add_argument("--top", type=int, default=15,
+                        help="slowest imports to show (default: 15)")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write results as JSON to PATH")
+    args = parser.parse_args()
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            [root] + [p for p in [env.get("PYTHONPATH")] if p])
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    results = {}
+    for name, arguments in commands:
+        run(arguments, env) # Warm up
+        times = sorted(run(arguments, env) for i in range(args.runs))
+        results[name] = {"median_ms": times[len(times) // 2] * 1e3,
+                         "min_ms": times[0] * 1e3}
+        print("%-30s median %7.1f ms   min %7.1f ms" %
+              (name, results[name]["median_ms"], results[name]["min_ms"]))
+    if sys.version_info >= (3, 7):
+        print("\nslowest imports of rk.rk (cumulative us):")
+        results["imports_us"] = import_times(env, args.top)
+        for microseconds, module in results["imports_us"]:
+            print("%10i  %s" % (microseconds, module))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(dumps(results, indent=1, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
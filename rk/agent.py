@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""Warm remote kernel agent
+
+The agent is a long-lived daemon on a remote machine, one per interpreter.
+It imports ipykernel (and optional scientific modules) once, then forks a
+ready kernel for every launch request it gets on a local unix socket, so a
+kernel start skips interpreter startup and imports.
+
+The source of this module is sent to the remote machine with execnet, by
+the "agent" subcommand (which calls `main`) and by the rkscript (which
+calls `connect`), so it must only use the standard library. The protocol
+is one JSON object per line:
+
+* ``{"command": "ping"}`` -> ``{"pid": AGENT_PID}``,
+* ``{"command": "stop"}`` -> ``{"pid": AGENT_PID}``, then the agent exits,
+* ``{"command": "launch", "connection_file": PATH, "cwd": PATH}`` ->
+  ``{"pid": KERNEL_PID}`` and, when the kernel exits,
+  ``{"exit": STATUS}``. Closing the connection kills the kernel.
+
+"""
+
+import os
+import signal
+import socket
+import sys
+from hashlib import sha1
+from json import dumps, loads
+from os.path import exists, expanduser, isdir, join
+from select import select
+
+agent_location = "~/.rk"
+
+def agent_socket_path(executable=None):
+    """Unix socket path of the agent for an interpreter"""
+
+    if executable is None:
+        executable = sys.executable
+    name = sha1(executable.encode("utf-8")).hexdigest()[:12]
+    return join(expanduser(agent_location), "agent-%s.sock" % name)
+
+def connect(path=None):
+    """Connect to a running agent, return a socket or None"""
+
+    if path is None:
+        path = agent_socket_path()
+    if not exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def send(sock, message):
+    """Send one JSON line"""
+
+    sock.sendall((dumps(message) + '\n').encode("utf-8"))
+
+def receive(sock):
+    """Receive one JSON line, None on EOF"""
+
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(1)
+        if not chunk:
+            return None
+        data += chunk
+    return loads(data.decode("utf-8"))
+
+def request(message, path=None):
+    """Send one request to a running agent, return the reply or None"""
+
+    sock = connect(path)
+    if sock is None:
+        return None
+    try:
+        send(sock, message)
+        return receive(sock)
+    finally:
+        sock.close()
+
+def daemonize(keep_fds=()):
+    """Double fork, return True in the daemon and False in the caller"""
+
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0) # The first child exits at once
+        return False
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    # Detach from the ssh session of the execnet gateway
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    for fd in range(3, 1024):
+        if fd not in keep_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    return True
+
+def preimport(modules):
+    """Import ipykernel and optional modules, return launch_new_instance"""
+
+    try:
+        from ipykernel.kernelapp import launch_new_instance
+    except ImportError:
+        from IPython.kernel.zmq.kernelapp import launch_new_instance
+    for module in modules:
+        try:
+            __import__(module)
+        except Exception:
+            pass
+    return launch_new_instance
+
+def launch(conn, message, launch_new_instance):
+    """Fork a kernel and supervise it for one client connection"""
+
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        cwd = message.get("cwd")
+        if cwd and exists(cwd) and isdir(cwd):
+            os.chdir(cwd)
+        try:
+            launch_new_instance(["-f", message["connection_file"]])
+        finally:
+            os._exit(0)
+    send(conn, {"pid": pid})
+    while True:
+        waited, status = os.waitpid(pid, os.WNOHANG)
+        if waited:
+            send(conn, {"exit": status})
+            return
+        r, w, x = select([conn], [], [], 1)
+        if r and not conn.recv(1):
+            # The client is gone: take the kernel down with it
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            return
+
+def serve(path, modules, ready_fd):
+    """Serve requests on a unix socket until a "stop" command
+
+    The pid is written to ready_fd once the socket is bound; requests that
+    arrive while modules are still being imported wait in the backlog.
+
+    """
+
+    if exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(64)
+    os.write(ready_fd, str(os.getpid()).encode("utf-8"))
+    os.close(ready_fd)
+    launch_new_instance = preimport(modules)
+    server.settimeout(60)
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            conn = None
+        # Reap finished session handlers
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except OSError:
+            pass
+        if conn is None:
+            continue
+        conn.settimeout(None)
+        message = receive(conn)
+        if message is None:
+            conn.close()
+        elif message.get("command") == "launch":
+            if os.fork() == 0:
+                server.close()
+                try:
+                    launch(conn, message, launch_new_instance)
+                finally:
+                    os._exit(0)
+            conn.close()
+        else:
+            send(conn, {"pid": os.getpid()})
+            conn.close()
+            if message.get("command") == "stop":
+                break
+    server.close()
+    os.remove(path)
+
+def start(modules):
+    """Start an agent unless it runs already, return its pid"""
+
+    reply = request({"command": "ping"})
+    if reply is not None:
+        return reply["pid"]
+    location = expanduser(agent_location)
+    if not exists(location):
+        os.makedirs(location, 0o700)
+    path = agent_socket_path()
+    r, w = os.pipe()
+    if daemonize(keep_fds=(w,)):
+        try:
+            serve(path, modules, w)
+        finally:
+            os._exit(0)
+    os.close(w)
+    pid = os.read(r, 32).decode("utf-8")
+    os.close(r)
+    return int(pid) if pid else None
+
+def main(channel):
+    """Handle one "start", "stop" or "ping" command from an execnet channel,
+    reply with the agent pid, or None if no agent is running
+
+    """
+
+    options = channel.receive()
+    if options["command"] == "start":
+        channel.send(start(options.get("modules", [])))
+    else:
+        reply = request({"command": options["command"]})
+        channel.send(None if reply is None else reply["pid"])
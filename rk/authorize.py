@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Install a public key on many remote hosts at once
+
+The key is appended to ``~/.ssh/authorized_keys`` on every remote host
+over a paramiko password login, from a bounded thread pool. The key is sent
+on stdin of the remote shell, so it is never quoted into a command line,
+and a key that is already in ``authorized_keys`` is not added again.
+
+"""
+
+# Read the key from stdin, append it unless it is there already
+install_command = ("umask 077 && mkdir -p ~/.ssh && read -r key && "
+                   "touch ~/.ssh/authorized_keys && "
+                   "{ grep -qxF \"$key\" ~/.ssh/authorized_keys || "
+                   "echo \"$key\" >> ~/.ssh/authorized_keys; }")
+
+def install_key(remote_host, public_key, password, timeout=None):
+    """Install public_key on remote_host, return None or an error string"""
+
+    from rk.ssh import tunnel
+
+    if tunnel.paramiko == None:
+        return "paramiko unavailable"
+    username, server, port = tunnel._split_server(remote_host)
+    client = tunnel._paramiko_client()
+    try:
+        client.connect(server, port, username=username, password=password,
+                       timeout=timeout, banner_timeout=timeout,
+                       auth_timeout=timeout)
+        stdin, stdout, stderr = client.exec_command(install_command,
+                                                    timeout=timeout)
+        stdin.write(public_key.strip() + '\n')
+        stdin.channel.shutdown_write()
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            error = stderr.read().decode("utf-8", "replace").strip()
+            return error or "exit status %s" % status
+    except Exception as exception:
+        return str(exception) or exception.__class__.__name__
+    finally:
+        client.close()
+    return None
+
+def install_keys(remote_hosts, public_key, password, workers=32,
+                 timeout=None):
+    """Install public_key on remote hosts in parallel,
+    return {remote host: None or an error string}
+
+    """
+
+    from rk.ssh import tunnel
+
+    remote_hosts = list(remote_hosts)
+    errors = tunnel.map_hosts(lambda remote_host: install_key(remote_host,
+                                      public_key, password, timeout),
+                              remote_hosts, workers)
+    return dict(zip(remote_hosts, errors))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Precompiled catalog of rk.ini, argparse.txt and messages.txt
+
+Every rk and rkscript run needs the settings and strings from the config
+files. Parsing them (and importing configobj) on every run costs more than
+the rest of a "rk --help", so they are compiled once into a marshal file and
+compiled again only when one of the config files changes.
+
+"""
+
+import marshal
+import sys
+from os import stat
+from os.path import abspath, expanduser, join
+from zlib import crc32
+
+catalog_location = "~/.cache/rk"
+catalog_version = 1
+
+def catalog_path(module_location):
+    """Catalog file path for an rk installation and Python version"""
+
+    name = "%08x" % (crc32(abspath(module_location).encode("utf-8")) &
+                    0xffffffff)
+    version = "%s%s" % sys.version_info[:2]
+    return join(expanduser(catalog_location),
+                "catalog-%s-py%s.marshal" % (name, version))
+
+def signature(path):
+    """Identify the current contents of a config file"""
+
+    st = stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def read_pairs(path):
+    """Read a "key" line, "value" line file into a dict"""
+
+    pairs = {}
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    for i in range(0, len(lines), 2):
+        pairs[lines[i]] = lines[i+1]
+    return pairs
+
+def compile_catalog(module_location):
+    """Parse the config files, return the catalog dict"""
+
+    from configobj import ConfigObj
+
+    config_rk_abs_path = join(module_location, "config/rk.ini")
+    config = dict(ConfigObj(config_rk_abs_path))
+    config_argparse_abs_path = join(module_location,
+                                    config["config_argparse_rel_path"])
+    config_messages_abs_path = join(module_location,
+                                    config["config_messages_rel_path"])
+    sources = [config_rk_abs_path, config_argparse_abs_path,
+               config_messages_abs_path]
+    return {"version": catalog_version,
+            "sources": [(path, signature(path)) for path in sources],
+            "config": config,
+            "argparse": read_pairs(config_argparse_abs_path),
+            "messages": read_pairs(config_messages_abs_path)}
+
+def load_catalog(module_location):
+    """Return the catalog dict with "config", "argparse" and "messages"
+    dicts, from the catalog file if it is up to date
+
+    """
+
+    path = catalog_path(module_location)
+    try:
+        with open(path, 'rb') as f:
+            catalog = marshal.loads(f.read())
+        if catalog["version"] == catalog_version:
+            for source, source_signature in catalog["sources"]:
+                if signature(source) != source_signature:
+                    break
+            else:
+                return catalog
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        pass
+    catalog = compile_catalog(module_location)
+    from rk.files import replace_file
+
+    try:
+        replace_file(path, marshal.dumps(catalog))
+    except (IOError, OSError, ValueError):
+        pass # Compiled again by the next run
+    return catalog
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Python interpreters with ipykernel on remote hosts
+
+Every remote host is asked, over one SSH session, for its Python
+interpreters: the ones on the PATH, conda environments (also from ``conda
+env list``), virtualenvs in the usual places and pyenv versions. Each
+candidate is tried at once, in parallel on the remote host, and only the
+interpreters that can import ipykernel are kept, one per environment.
+Remote hosts are asked from a bounded thread pool, like `rk.probe`, and
+the results are kept in a JSON cache, one record per remote host:
+
+* ``checked`` -- when the host was asked (seconds since the epoch),
+* ``interpreters`` -- a list of ``{"path", "version", "prefix", "kind"}``,
+  where kind is "conda", "venv" or "system",
+* ``error`` -- why the host could not be asked, or None.
+
+"""
+
+import re
+from time import time
+
+# An sh script, prints "path TAB version TAB sys.prefix TAB kind" for every
+# interpreter that imports ipykernel
+discover_command = r"""
+candidates() {
+    for name in python3 python python2; do command -v "$name"; done
+    for path in /usr/bin/python[23]* /usr/local/bin/python[23]* \
+            "$HOME"/anaconda*/bin/python "$HOME"/miniconda*/bin/python \
+            "$HOME"/miniforge*/bin/python "$HOME"/mambaforge*/bin/python \
+            /opt/conda/bin/python "$HOME"/anaconda*/envs/*/bin/python \
+            "$HOME"/miniconda*/envs/*/bin/python \
+            "$HOME"/miniforge*/envs/*/bin/python \
+            "$HOME"/mambaforge*/envs/*/bin/python \
+            /opt/conda/envs/*/bin/python "$HOME"/.conda/envs/*/bin/python \
+            "$HOME"/.virtualenvs/*/bin/python "$HOME"/venvs/*/bin/python \
+            "$HOME"/.venvs/*/bin/python "$HOME"/.pyenv/versions/*/bin/python
+    do
+        echo "$path"
+    done
+    conda env list 2>/dev/null | awk '!/^#/ && NF {print $NF "/bin/python"}'
+}
+candidates | sort -u | {
+    while read -r path; do
+        [ -f "$path" ] && [ -x "$path" ] || continue
+        (
+        info=$("$path" -c '
+import os, sys, ipykernel
+base = getattr(sys, "real_prefix", getattr(sys, "base_prefix", sys.prefix))
+if os.path.isdir(os.path.join(sys.prefix, "conda-meta")):
+    kind = "conda"
+elif sys.prefix != base:
+    kind = "venv"
+else:
+    kind = "system"
+sys.stdout.write("%d.%d.%d\t%s\t%s" % (sys.version_info[:3] +
+                                       (sys.prefix, kind)))
+' 2>/dev/null) && printf '%s\t%s\n' "$path" "$info"
+        ) &
+    done
+    wait
+}
+"""
+
+def parse_interpreters(output):
+    """Return the interpreters from the discover_command output, one per
+    environment and Python version, with the shortest path
+
+    """
+
+    interpreters = {} # (prefix, version): interpreter
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 4:
+            continue
+        path, version, prefix, kind = fields
+        key = (prefix, version)
+        if key not in interpreters or (len(path), path) < (
+                len(interpreters[key]["path"]), interpreters[key]["path"]):
+            interpreters[key] = {"path": path, "version": version,
+                                 "prefix": prefix, "kind": kind}
+    return sorted(interpreters.values(),
+                  key=lambda i: (i["prefix"], i["version"]))
+
+def discover_host(remote_host, timeout=None):
+    """Ask one remote host for its interpreters, return its record"""
+
+    from rk.ssh import tunnel
+
+    record = {"checked": time(), "interpreters": [], "error": None}
+    username, server, port = tunnel._split_server(remote_host)
+    client = tunnel._paramiko_client()
+    try:
+        client.connect(server, port, username=username, timeout=timeout,
+                       banner_timeout=timeout, auth_timeout=timeout)
+        # The script goes to sh on stdin, whatever the login shell is
+        stdin, stdout, stderr = client.exec_command("sh -s", timeout=timeout)
+        stdin.write(discover_command)
+        stdin.channel.shutdown_write()
+        output = stdout.read().decode("utf-8", "replace")
+        record["interpreters"] = parse_interpreters(output)
+    except Exception as exception:
+        record["error"] = str(exception) or exception.__class__.__name__
+    finally:
+        client.close()
+    return record
+
+def discover_hosts(remote_hosts, workers=32, timeout=None):
+    """Ask remote hosts in parallel, return {remote host: record}"""
+
+    from rk.ssh import tunnel
+
+    remote_hosts = list(remote_hosts)
+    records = tunnel.map_hosts(lambda remote_host: discover_host(remote_host,
+                                                                 timeout),
+                               remote_hosts, workers)
+    return dict(zip(remote_hosts, records))
+
+def _name_part(text):
+    """Keep the characters allowed in a kernel name"""
+
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", text).strip("-")
+
+def environment_name(interpreter):
+    """Return a short name of the environment of an interpreter, e.g. the
+    conda environment name or "python3.6"
+
+    """
+
+    if interpreter["kind"] == "system":
+        return "python" + ".".join(interpreter["version"].split('.')[:2])
+    return interpreter["prefix"].rstrip('/').split('/')[-1]
+
+def kernel_entries(remote_host, interpreters):
+    """Return {kernel name: kernel} for kernels dict, one kernel per
+    interpreter of remote_host
+
+    """
+
+    entries = {}
+    for interpreter in interpreters:
+        environment = environment_name(interpreter)
+        kernel_name = "%s-%s" % (_name_part(remote_host.replace('@', '_')),
+                                 _name_part(environment))
+        entries[kernel_name] = {
+                "display_name": "Python %s (%s) on %s" % (
+                        ".".join(interpreter["version"].split('.')[:2]),
+                        environment, remote_host.split('@')[-1]),
+                "interpreter": interpreter["path"],
+                "language": "python",
+                "remote_host": remote_host}
+    return entries
+
+
+__all__ = ['discover_host', 'discover_hosts', 'kernel_entries']
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""Replacing files in one step
+
+Caches, manifests and records are read by other rk processes while they
+are rewritten, so they are written to a temporary file next to them, then
+renamed over them: readers see the old file or the new one, never half of
+it.
+
+The source of this module is also sent to remote machines by `rk.sync`,
+so it must only use the standard library.
+
+"""
+
+import errno
+import os
+
+def replace_file(path, data, location_mode=0o777):
+    """Replace the file at path with data: a str, bytes, or a list of them
+    written one after another. The directory of path is made first, with
+    location_mode, if it does not exist.
+
+    """
+
+    location = os.path.dirname(path)
+    if location and not os.path.isdir(location):
+        try:
+            os.makedirs(location, location_mode)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST: # Made meanwhile
+                raise
+    if not isinstance(data, (list, tuple)):
+        data = [data]
+    tmp_path = "%s.%s" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb' if isinstance(data[0], bytes) else 'w') as f:
+            for chunk in data:
+                f.write(chunk)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+__all__ = ['replace_file']
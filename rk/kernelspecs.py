@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Kernelspecs installed by rk: the ownership manifest and the trash
+
+rk keeps the names of the kernels it installed in ``.rk-manifest.json`` in
+kernels location, so uninstall and sync only touch those, never the other
+kernelspecs there. A kernels location without a manifest, from an older
+rk, is adopted: its kernels launched by the rkscript are taken as rk's.
+
+Deleted kernels are renamed into ``.rk-trash`` in kernels location, on the
+same filesystem, so deleting is one rename per kernel, and a background
+process removes the trash, also anything left there by an earlier run.
+
+"""
+
+import sys
+from json import dumps, load, loads
+from os import getpid, listdir, makedirs, remove, rename
+from os.path import basename, isdir, isfile, join
+from shutil import rmtree
+
+manifest_name = ".rk-manifest.json"
+manifest_version = 1
+trash_name = ".rk-trash"
+
+def adopt(kernels_location, script):
+    """Return the names of the kernels launched by script, in kernels
+    location
+
+    """
+
+    names = set()
+    if not isdir(kernels_location):
+        return names
+    for name in listdir(kernels_location):
+        if name.startswith('.'):
+            continue # Staging dirs, the trash
+        try:
+            with open(join(kernels_location, name, "kernel.json"), 'r') as f:
+                kernel_argv = loads(f.read())["argv"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            continue
+        if kernel_argv and kernel_argv[0] == script:
+            names.add(name)
+    return names
+
+def load_owned(kernels_location, script):
+    """Return the set of kernel names installed by rk. Without a manifest,
+    the kernels launched by script are adopted.
+
+    """
+
+    try:
+        with open(join(kernels_location, manifest_name), 'r') as f:
+            manifest = load(f)
+        if manifest["version"] == manifest_version:
+            return set(manifest["kernels"])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return adopt(kernels_location, script)
+
+def save_owned(kernels_location, names):
+    """Replace the manifest with names"""
+
+    from rk.files import replace_file
+
+    replace_file(join(kernels_location, manifest_name),
+                 dumps({"version": manifest_version,
+                        "kernels": sorted(names)}, indent=1))
+
+def update_owned(kernels_location, script, added=(), removed=()):
+    """Add and remove kernel names in the manifest"""
+
+    names = load_owned(kernels_location, script)
+    names.update(added)
+    names.difference_update(removed)
+    save_owned(kernels_location, names)
+
+def move_to_trash(kernels_location, paths):
+    """Rename paths, in kernels location, into the trash"""
+
+    trash_location = join(kernels_location, trash_name)
+    if not isdir(trash_location):
+        try:
+            makedirs(trash_location, 0o755)
+        except OSError:
+            if not isdir(trash_location): # Not made by another rk meanwhile
+                raise
+    prefix = "%s-" % getpid()
+    for i, path in enumerate(paths):
+        # Unique in the trash, e.g. for a kernel deleted twice
+        rename(path, join(trash_location,
+                          "%s%s-%s" % (prefix, i, basename(path))))
+
+def empty_trash(kernels_location):
+    """Remove everything in the trash"""
+
+    trash_location = join(kernels_location, trash_name)
+    if not isdir(trash_location):
+        return
+    for name in listdir(trash_location):
+        path = join(trash_location, name)
+        if isdir(path):
+            rmtree(path, ignore_errors=True)
+        elif isfile(path):
+            try:
+                remove(path)
+            except OSError:
+                pass
+
+def empty_trash_later(kernels_location):
+    """Empty the trash in a background process, so the caller returns at
+    once. Without fork, e.g. on Windows, empty it now.
+
+    """
+
+    if not isdir(join(kernels_location, trash_name)):
+        return
+    if sys.platform == "win32":
+        empty_trash(kernels_location)
+        return
+    from os import _exit, close, devnull, dup2, fork, open as os_open, setsid
+    from os import O_RDWR, waitpid
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Double fork, as `rk.agent.daemonize`, without the imports of the
+    # agent
+    pid = fork()
+    if pid != 0:
+        waitpid(pid, 0) # The first child exits at once
+        return
+    try:
+        setsid()
+        # Let go of the terminal and of pipes, e.g. of $(rk uninstall-all),
+        # so readers of the caller's output do not wait for the removal
+        null_fd = os_open(devnull, O_RDWR)
+        for fd in range(3):
+            dup2(null_fd, fd)
+        for fd in range(3, 1024):
+            try:
+                close(fd)
+            except OSError:
+                pass
+        if fork() == 0:
+            empty_trash(kernels_location)
+    finally:
+        _exit(0)
+
+
+__all__ = ['load_owned', 'update_owned', 'move_to_trash', 'empty_trash',
+           'empty_trash_later']
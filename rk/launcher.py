@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+
+"""Launch remote jupyter kernels, from the rkscript or from Python
+
+`launch_kernel` starts one kernel: it binds the local ports, starts the
+kernel on the remote machine over execnet, forwards the ports over SSH and
+registers the session, then returns a `Kernel`. `Kernel.wait` blocks until
+the kernel exits and cleans up after it. Both may run in many threads at
+once, so one process can start and supervise many kernels across hosts.
+
+On Python 3, `launch` and `wait` return asyncio futures of the same::
+
+    kernels = await asyncio.gather(*[launch(host, "python3", path)
+                                     for host, path in jobs])
+    await asyncio.gather(*[wait(kernel) for kernel in kernels])
+
+"""
+
+import logging
+import threading
+from datetime import datetime
+from getpass import getuser
+from json import load
+from os import chmod, getcwd, getpid, makedirs, remove
+from os.path import dirname, exists, expanduser, isfile, join, split
+
+from rk.catalog import load_catalog
+
+try:
+    from time import monotonic
+except ImportError: # Python 2
+    from time import time as monotonic
+
+module_location = dirname(__file__)
+config = load_catalog(module_location)["config"]
+
+week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
+        'Sunday']
+
+# Tunnel processes are forked one at a time, each with only its own
+# paramiko log handler
+_fork_lock = threading.Lock()
+
+# Run on a remote machine, after the agent and ports modules: write the
+# connection file with free remote ports, and start the kernel, forked from
+# a warm agent ("rk agent") if it runs. Sends back the remote ports, the
+# kernel pid, timings and where the connection file is.
+_remote_code = """
+from json import dumps
+from os import chdir, chmod, getcwd, getpid, makedirs, remove
+from os.path import exists, expanduser, isdir, isfile, join, split
+import os
+import stat
+import time # A module, as in the ports functions
+
+remote_timings = {}
+# A marker of every running kernel, counted by the load-aware host selection
+kernels_location = "%s"
+def mark_kernel(pid):
+    marker = join(kernels_location, str(pid))
+    try:
+        if not exists(kernels_location):
+            makedirs(kernels_location)
+            chmod(kernels_location, 0o1777) # Shared by all users, like /tmp
+        # Never through a file or link planted by another user
+        os.close(os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                                 getattr(os, "O_NOFOLLOW", 0), 0o644))
+    except OSError:
+        try:
+            st = os.lstat(marker)
+        except OSError:
+            return None
+        # Left by an earlier kernel of the user with the same pid
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+            return None
+    return marker
+
+# Fork the kernel from a warm agent ("rk agent"), if it runs
+agent_sock = connect()
+if agent_sock is None:
+    started = time.time()
+    try:
+        from ipykernel.kernelapp import launch_new_instance
+    except ImportError:
+        from IPython.kernel.zmq.kernelapp import launch_new_instance
+    remote_timings["import_ipykernel"] = time.time() - started
+
+remote_connection_file = "%s"
+cfg = %s
+last_cwd = "%s"
+remote_ports = {}
+
+started = time.time()
+ports = [k for k,v in cfg.items() if k.endswith("_port")]
+# Select free ports, kept bound until the kernel starts and leased
+# against other kernels starting at the same time
+socks = allocate(len(ports), parse_port_range("%s"), host='')
+for port, sock in zip(ports, socks):
+    sock_name = sock.getsockname()[1]
+    remote_ports[port] = sock_name
+    cfg[port] = sock_name
+remote_timings["select_ports"] = time.time() - started
+channel.send(remote_ports)
+if not exists(remote_connection_file):
+    dir_name, file_name = split(remote_connection_file)
+    if exists(dir_name) and isdir(dir_name):
+        # Write a connection file
+        with open(remote_connection_file, 'w') as f:
+            f.write(dumps(cfg))
+    else:
+        default_j4_dir_name = "/run/user/1000/jupyter"
+        if ((default_j4_dir_name != dir_name) and
+                exists(default_j4_dir_name) and
+                isdir(default_j4_dir_name)):
+            remote_connection_file = join(default_j4_dir_name, file_name)
+            # Write a connection file to jupyter 4 "j4" default dir
+            with open(remote_connection_file, 'w') as f:
+                f.write(dumps(cfg))
+        else:
+            path = "~/.ipython/profile_default/security"
+            default_j3_dir_name = (expanduser(path))
+            if ((default_j3_dir_name != dir_name) and
+                    exists(default_j3_dir_name) and
+                    isdir(default_j3_dir_name)):
+                remote_connection_file = join(default_j3_dir_name,
+                                              file_name)
+                # Write a connection file to jupyter 3 "j3" default dir
+                with open(remote_connection_file, 'w') as f:
+                    f.write(dumps(cfg))
+            else:
+                cwd = getcwd()
+                remote_connection_file = join(cwd, file_name)
+                # Write a connection file to cwd
+                with open(remote_connection_file, 'w') as f:
+                    f.write(dumps(cfg))
+for sock in socks:
+    sock.close() # For the kernel to bind
+if agent_sock is None:
+    remote_pid = getpid()
+    marker = mark_kernel(remote_pid)
+    channel.send(remote_pid)
+    channel.send(remote_timings)
+    channel.send(remote_connection_file)
+    # SET a current working directory of a process
+    if exists(last_cwd) and isdir(last_cwd):
+        chdir(last_cwd)
+    launch_new_instance(["-f", remote_connection_file])
+else:
+    started = time.time()
+    send(agent_sock, {"command": "launch",
+                      "connection_file": remote_connection_file,
+                      "cwd": last_cwd})
+    remote_pid = receive(agent_sock)["pid"]
+    marker = mark_kernel(remote_pid)
+    remote_timings["agent_launch"] = time.time() - started
+    channel.send(remote_pid)
+    channel.send(remote_timings)
+    channel.send(remote_connection_file)
+    # Waits for the kernel exit
+    receive(agent_sock)
+    agent_sock.close()
+# Delete a connection file and the marker
+if exists(remote_connection_file) and isfile(remote_connection_file):
+    remove(remote_connection_file)
+if marker != None:
+    try:
+        remove(marker)
+    except OSError:
+        pass
+"""
+
+def get_date_time():
+    """Get yyyy-mm-dd_hh.mm.ss"""
+
+    return datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+
+def remote_code(remote_connection_file, cfg, cwd, port_range="",
+                kernels_location="/tmp/rk/kernels"):
+    """Return the code that starts a kernel on a remote machine"""
+
+    from inspect import getsource
+
+    from rk import agent
+    from rk.ssh import ports
+
+    # The agent and ports functions come first, to reach a warm agent and
+    # to select ports on a remote machine
+    return getsource(agent) + getsource(ports) + _remote_code % (
+            kernels_location, remote_connection_file, cfg, cwd, port_range)
+
+def _remove(path):
+    """Delete a file, if it exists"""
+
+    if path != None and exists(path) and isfile(path):
+        remove(path)
+
+def _paramiko_log_handler(path):
+    """Return a paramiko log file handler, like paramiko.util.log_to_file"""
+
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(
+            "%(levelname)-.3s [%(asctime)s.%(msecs)03d] %(name)s: "
+            "%(message)s", "%Y%m%d-%H:%M:%S"))
+    return handler
+
+class Kernel(object):
+    """A remote jupyter kernel started by `launch_kernel`"""
+
+    def __init__(self, remote_host, interpreter, connection_file):
+        self.remote_host = remote_host # As given, maybe with a username
+        self.remote_username_at_remote_host = remote_host # For SSH
+        self.interpreter = interpreter
+        self.connection_file = connection_file
+        self.remote_connection_file = None
+        self.local_ports = {} # Port name: local port
+        self.remote_ports = {} # Port name: remote port
+        self.local_pid = getpid()
+        self.remote_pid = None
+        self.tunnel = None # The paramiko tunnel process
+        self.tunnel_pid = None
+        self.gateway = None
+        self.channel = None
+        self.session = None
+        self.stats_file = None
+        self.paramiko_log = None
+        self.rk_log = None
+        self.timer = None
+        self.host_loads = {} # Remote host: load record, for a pool
+        self.sync_report = None # See `rk.sync.sync_tree`
+        self.tunnel_backend = config["tunnel_backend"]
+
+    def record(self):
+        """Return the session record, see `rk.sessions`"""
+
+        from rk.sessions import process_cmdline
+
+        return {"session": self.session,
+                "connection_file": self.connection_file,
+                "cmdline": process_cmdline(self.local_pid),
+                "remote_connection_file": self.remote_connection_file,
+                "remote_host": self.remote_username_at_remote_host,
+                "interpreter": self.interpreter,
+                "tunnel_backend": self.tunnel_backend,
+                "local_pid": self.local_pid,
+                "tunnel_pid": self.tunnel_pid,
+                "remote_pid": self.remote_pid,
+                "port_pairs": [[v, self.remote_ports[k]]
+                               for k,v in self.local_ports.items()],
+                "started": self.timer.fields["timestamp"],
+                "stats_file": self.stats_file}
+
+    def is_alive(self):
+        return self.channel != None and not self.channel.isclosed()
+
+    def wait(self, timeout=None):
+        """Wait for the kernel exit, then stop the tunnel and delete the
+        log files and the session record. Raises the remote error, if the
+        kernel failed on the remote machine.
+
+        """
+
+        try:
+            self.channel.waitclose(timeout)
+        finally:
+            if not self.is_alive():
+                self.close()
+
+    def stop(self, timeout=None):
+        """Kill the remote kernel and wait for its exit. Return None or an
+        error string.
+
+        """
+
+        from rk.sessions import kill_remote_kernel
+
+        error = kill_remote_kernel(self.record(), timeout)
+        if error == None:
+            self.wait(timeout)
+        return error
+
+    def close(self):
+        """Stop the tunnel and the gateway, delete the log files and the
+        session record
+
+        """
+
+        from rk.sessions import remove_session
+        from rk.ssh.tunnel import _shutdown_process
+
+        if self.tunnel != None:
+            _shutdown_process(self.tunnel)
+            self.tunnel.join()
+        if self.gateway != None:
+            self.gateway.exit()
+        _remove(self.paramiko_log)
+        remove_session(expanduser(config["rk_sessions_location"]),
+                       self.session, self.stats_file)
+        _remove(self.rk_log)
+
+def launch_kernel(remote_host, interpreter, connection_file,
+                  ssh_options=None, cwd=None, sync=None):
+    """Launch a kernel on remote_host, for a local connection file.
+    Return a `Kernel` once the kernel runs and its ports are forwarded.
+
+    Parameters
+    ----------
+
+    remote_host : str or list of str
+        Just a remote host or, if your username is different on a remote
+        machine, remote username AT remote host. Several remote hosts, as a
+        list or joined by commas, are a pool: the kernel is started on the
+        least loaded one, see `rk.placement`.
+    interpreter : str
+        An entry point or an absolute path to language interpreter on the
+        remote machine.
+    connection_file : str
+        Absolute path of a local connection file.
+    ssh_options : dict
+        SSH transport settings of the tunnel: "ciphers", "macs" and
+        "compression", see `rk.ssh.tunnel.paramiko_multi_tunnel`.
+    cwd : str
+        The working directory of the kernel, if it exists on the remote
+        machine. Defaults to the current one.
+    sync : dict
+        Copy the working directory to the remote machine before the kernel
+        starts, only the changed files, and start the kernel in the copy,
+        see `rk.sync`. Optional "ignore" patterns, "max_file_size" and
+        "max_size" (MiB) override the sync settings of rk.ini. None for no
+        sync.
+
+    """
+
+    from execnet import makegateway
+
+    from rk.sessions import session_id
+    from rk.ssh import ports
+    from rk.timing import PhaseTimer
+
+    from rk.placement import select_host
+
+    # Pick the least loaded host of a pool
+    started = monotonic()
+    remote_host, loads = select_host(remote_host,
+            config["rk_remote_kernels_location"],
+            float(config["host_select_timeout"]),
+            int(config["host_min_free_memory"]))
+    select_host_time = monotonic() - started
+    kernel = Kernel(remote_host, interpreter, connection_file)
+    kernel.host_loads = loads
+    ssh_options = ssh_options or {}
+    local_username = getuser()
+    remote_username_at_remote_host = remote_host
+    if '@' in remote_username_at_remote_host:
+        remote_username, remote_host = remote_username_at_remote_host.split(
+                '@')
+        if local_username != remote_username:
+            # Local username is NOT the same as a remote username
+            remote_connection_file = connection_file.replace(local_username,
+                                                             remote_username)
+        else:
+            # Local username is the same as a remote username
+            remote_connection_file = connection_file
+            remote_username_at_remote_host = remote_host
+    else:
+        # Local username is the same as a remote username
+        remote_connection_file = connection_file
+        remote_username = local_username
+    kernel.remote_username_at_remote_host = remote_username_at_remote_host
+    kernel.session = session_id(connection_file)
+    # Time every launch phase
+    timer = kernel.timer = PhaseTimer(local_username=local_username,
+            remote_host=remote_host, interpreter=interpreter,
+            local_pid=kernel.local_pid,
+            connection_file=split(connection_file)[1])
+    if loads:
+        timer.add("select_host", select_host_time)
+    # Load a connection file
+    with timer.phase("read_connection_file"):
+        with open(connection_file, 'r') as f:
+            cfg = load(f)
+    # Local and remote ports dicts. Bind the local ports at once, so that no
+    # other process takes them before the tunnels start; the bound sockets
+    # are handed to the tunnels.
+    kernel.local_ports = {k: v for k,v in cfg.items() if k.endswith("_port")}
+    local_sockets = {}
+    try:
+        with timer.phase("bind_local_ports"):
+            for k,v in kernel.local_ports.items():
+                local_sockets[k] = ports.listen(v)
+        # Launch a kernel process on a remote machine
+        with timer.phase("makegateway"):
+            kernel.gateway = makegateway("ssh=%s//python=%s" % (
+                    remote_username_at_remote_host, interpreter))
+        cwd = cwd or getcwd()
+        if sync != None:
+            with timer.phase("sync"):
+                kernel.sync_report = _sync(kernel.gateway, cwd, sync)
+            cwd = kernel.sync_report["root"]
+        with timer.phase("remote_exec"):
+            kernel.channel = kernel.gateway.remote_exec(remote_code(
+                    remote_connection_file, cfg, cwd,
+                    config["port_range"],
+                    config["rk_remote_kernels_location"]))
+        with timer.phase("receive_ports"):
+            kernel.remote_ports = kernel.channel.receive()
+        with timer.phase("receive_pid"):
+            kernel.remote_pid = kernel.channel.receive()
+        for k,v in kernel.channel.receive().items():
+            timer.add("remote_" + k, v)
+        # Where it is written
+        kernel.remote_connection_file = kernel.channel.receive()
+        _start_tunnel(kernel, local_sockets, ssh_options)
+        _write_rk_log(kernel, local_username, remote_username, remote_host)
+    except BaseException:
+        for sock in local_sockets.values():
+            sock.close()
+        if kernel.tunnel != None:
+            from rk.ssh.tunnel import _shutdown_process
+
+            _shutdown_process(kernel.tunnel)
+        if kernel.gateway != None:
+            kernel.gateway.exit()
+        _remove(kernel.paramiko_log)
+        raise
+    _register(kernel)
+    return kernel
+
+def _sync(gateway, cwd, options):
+    """Sync cwd to the remote machine, return the report"""
+
+    from hashlib import sha1
+
+    from rk.sync import sync_tree
+
+    mib = 1024 * 1024
+    ignore = options.get("ignore")
+    if ignore is None:
+        ignore = [pattern for pattern in config["sync_ignore"].split(',')
+                  if pattern]
+    max_file_size = options.get("max_file_size",
+                                config["sync_max_file_size"])
+    max_size = options.get("max_size", config["sync_max_size"])
+    # One local manifest cache per tree
+    cache_path = join(expanduser(config["rk_cache_location"]),
+                      config["sync_cache_dir_name"],
+                      sha1(cwd.encode("utf-8")).hexdigest() + ".json")
+    return sync_tree(gateway, cwd, config["rk_remote_sync_location"],
+                     ignore, int(float(max_file_size) * mib),
+                     int(float(max_size) * mib), cache_path)
+
+def _start_tunnel(kernel, local_sockets, ssh_options):
+    """Redirect localhost:local_port to remote_host:remote_port, all ports
+    over one SSH connection
+
+    """
+
+    from rk.probe import is_fresh, load_probes
+    from rk.ssh import (openssh_multi_tunnel, paramiko_multi_tunnel,
+                        remember_passwordless)
+
+    timer = kernel.timer
+    # Paramiko log file, next to the connection file
+    paramiko_log_location, paramiko_log_file_name = split(
+            kernel.connection_file)
+    paramiko_log_file_name = paramiko_log_file_name.replace("kernel",
+                                                            "paramiko")
+    paramiko_log_file_name = paramiko_log_file_name.replace(".json", ".txt")
+    kernel.paramiko_log = join(paramiko_log_location, paramiko_log_file_name)
+    with timer.phase("tunnels"):
+        port_names = list(local_sockets) # E.g. "iopub_port"
+        port_pairs = [(local_sockets[k], kernel.remote_ports[k])
+                      for k in port_names]
+        if kernel.tunnel_backend == "openssh":
+            # One "ssh -f" process, or one "ssh -O forward" to a
+            # ControlMaster
+            openssh_multi_tunnel(port_pairs,
+                                 kernel.remote_username_at_remote_host,
+                                 **ssh_options)
+            return # It exits by itself, once unused
+        # Skip the passwordless login check, if "rk probe" saw it work
+        # recently, over paramiko too
+        probe = load_probes(join(expanduser(config["rk_cache_location"]),
+                config["probe_cache_file_name"])).get(kernel.remote_host)
+        if is_fresh(probe, int(config["probe_ttl"])) and probe["auth"]:
+            remember_passwordless(kernel.remote_username_at_remote_host, None,
+                                  True, paramiko=True)
+        # Traffic and latency stats of every port, in the Prometheus text
+        # format
+        kernel.stats_file = join(expanduser(config["rk_stats_location"]),
+                                 kernel.session + ".prom")
+        logger = logging.getLogger("paramiko")
+        handler = _paramiko_log_handler(kernel.paramiko_log)
+        with _fork_lock:
+            level = logger.level
+            logger.addHandler(handler)
+            logger.setLevel(logging.DEBUG)
+            try:
+                # Keepalives detect a dead connection, which is reconnected
+                # on the same local ports
+                kernel.tunnel = paramiko_multi_tunnel(port_pairs,
+                        kernel.remote_username_at_remote_host,
+                        keepalive_interval=int(config["keepalive_interval"]),
+                        keepalive_count_max=int(config["keepalive_count_max"]),
+                        reconnect_delay_max=int(config["reconnect_delay_max"]),
+                        port_names=[k[:-len("_port")] for k in port_names],
+                        stats_path=kernel.stats_file,
+                        stats_interval=int(config["stats_interval"]),
+                        stats_labels={"session": kernel.session,
+                                "remote_host":
+                                kernel.remote_username_at_remote_host},
+                        **ssh_options)
+            finally:
+                # The tunnel process has its own copy
+                logger.removeHandler(handler)
+                logger.setLevel(level)
+                handler.close()
+        kernel.tunnel_pid = kernel.tunnel.pid
+
+def _write_rk_log(kernel, local_username, remote_username, remote_host):
+    """Create rk log file"""
+
+    timer = kernel.timer
+    timer.begin("rk_log")
+    date_time = get_date_time()
+    date, time = date_time.replace('.', ':').split('_')
+    date = date + ' ' + week[datetime.weekday(datetime.now())]
+    rk_log_file_name = "%s@%s_%s.txt" % (local_username, remote_host,
+                                         date_time)
+    rk_log_location = expanduser(config["rk_log_location"])
+    kernel.rk_log = join(rk_log_location, rk_log_file_name)
+    if exists(rk_log_location) and isfile(rk_log_location):
+        remove(rk_log_location)
+    if not exists(rk_log_location):
+        try:
+            makedirs(rk_log_location, 0o777)
+        except OSError:
+            if not exists(rk_log_location): # Not made by another kernel
+                raise
+        path = rk_log_location
+        while path != '/':
+            try:
+                chmod(path, 0o777)
+            except OSError:
+                break
+            path = dirname(path)
+    with open(kernel.rk_log, 'w') as f:
+        f.write("date: %s\n" % date)
+        f.write("time: %s\n" % time)
+        f.write("\n")
+        if local_username == remote_username:
+            f.write("usernames: %s\n" % local_username)
+        else:
+            f.write("usernames: %s<->%s\n" % (local_username, remote_username))
+        f.write("remote host: %s\n" % remote_host)
+        f.write("\n")
+        for k,v in kernel.local_ports.items():
+            f.write("%ss: %s<->%s\n" % (k.replace('_', ' '), v,
+                                        kernel.remote_ports[k]))
+        f.write("\n")
+        f.write("pids: %s<->%s\n" % (kernel.local_pid, kernel.remote_pid))
+        if kernel.sync_report != None:
+            report = kernel.sync_report
+            f.write("\n")
+            f.write("sync: %s\n" % report["root"])
+            f.write("synced files: %i sent (%i bytes), %i unchanged, "
+                    "%i removed, %i skipped\n" % (report["sent"],
+                    report["sent_bytes"], report["unchanged"],
+                    report["removed"], len(report["skipped"])))
+    timer.end("rk_log")
+
+def _register(kernel):
+    """Register the session, for "rk ps" and "rk gc", and write timings,
+    a best effort: they must not stop the kernel
+
+    """
+
+    from rk.sessions import write_session
+
+    try:
+        write_session(expanduser(config["rk_sessions_location"]),
+                      kernel.record())
+    except (IOError, OSError):
+        pass
+    kernel.timer.total("startup")
+    try:
+        kernel.timer.write(join(expanduser(config["rk_timing_location"]),
+                                config["rk_timing_file_name"]),
+                           int(config["rk_timing_max_size"]) * 1048576)
+    except (IOError, OSError):
+        pass
+
+def _future(function, *args, **kwargs):
+    """Run function in a thread of its own, return an asyncio future of its
+    result. Not the default executor: a `Kernel.wait` holds its thread for
+    the lifetime of the kernel, and would starve the other launches.
+
+    """
+
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def resolve(result, exception):
+        if future.cancelled():
+            return
+        if exception != None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            result, exception = function(*args, **kwargs), None
+        except BaseException as error:
+            result, exception = None, error
+        try:
+            loop.call_soon_threadsafe(resolve, result, exception)
+        except RuntimeError: # The loop is closed, nobody waits
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def launch(remote_host, interpreter, connection_file, ssh_options=None,
+           cwd=None, sync=None):
+    """`launch_kernel` for asyncio: return a future of the `Kernel`"""
+
+    return _future(launch_kernel, remote_host, interpreter, connection_file,
+                   ssh_options, cwd, sync)
+
+def wait(kernel, timeout=None):
+    """`Kernel.wait` for asyncio: return a future, done on the kernel exit"""
+
+    return _future(kernel.wait, timeout)
+
+
+__all__ = ['Kernel', 'launch', 'launch_kernel', 'remote_code', 'wait']
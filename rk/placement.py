@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Load-aware selection of a remote host from a pool
+
+A kernel in kernels dict may have a list of remote hosts. At launch, every
+host is asked, over SSH and in parallel, for its load average, CPU count,
+available memory and count of running rk kernels, and the kernel is
+started on the least loaded host that answered before the deadline. A
+load record:
+
+* ``load`` -- the 1 minute load average,
+* ``cpus`` -- online CPUs,
+* ``free`` -- available memory, MiB,
+* ``kernels`` -- running rk kernels, from the markers that the remote
+  code of the launcher keeps in the remote kernels location.
+
+"""
+
+import threading
+
+try:
+    from time import monotonic
+except ImportError: # Python 2
+    from time import time as monotonic
+
+# Prints the load average line, CPU count, available memory (KiB) and the
+# count of running kernels, one per line
+load_command = ("cat /proc/loadavg; getconf _NPROCESSORS_ONLN; "
+                "awk '/^MemAvailable:/ {print $2}' /proc/meminfo; "
+                "n=0; for f in '%s'/*; do "
+                "[ -d \"/proc/${f##*/}\" ] && n=$((n+1)); done; echo $n")
+
+def split_hosts(remote_host):
+    """Return the remote hosts of a "remote_host" value: a list, or hosts
+    joined by commas
+
+    """
+
+    if isinstance(remote_host, list):
+        return list(remote_host)
+    return [host for host in remote_host.split(',') if host]
+
+def query_load(remote_host, kernels_location, timeout=None):
+    """Return the load record of remote_host, or None if it does not
+    answer
+
+    """
+
+    from rk.ssh import tunnel
+
+    username, server, port = tunnel._split_server(remote_host)
+    client = tunnel._paramiko_client()
+    try:
+        client.connect(server, port, username=username, timeout=timeout,
+                       banner_timeout=timeout, auth_timeout=timeout)
+        stdin, stdout, stderr = client.exec_command(
+                load_command % kernels_location.replace("'", ""),
+                timeout=timeout)
+        lines = stdout.read().decode("utf-8", "replace").split('\n')
+        return {"load": float(lines[0].split()[0]),
+                "cpus": max(1, int(lines[1])),
+                "free": int(lines[2]) // 1024,
+                "kernels": int(lines[3])}
+    except Exception:
+        return None
+    finally:
+        client.close()
+
+def host_loads(remote_hosts, kernels_location, timeout):
+    """Query remote hosts in parallel, return {remote host: load record}
+    of the hosts that answered within timeout seconds
+
+    """
+
+    import logging
+
+    # Unreachable hosts are left out, keep paramiko tracebacks off the
+    # terminal
+    logging.getLogger("paramiko").addHandler(logging.NullHandler())
+    loads = {}
+    lock = threading.Lock()
+
+    def query(remote_host):
+        record = query_load(remote_host, kernels_location, timeout)
+        if record != None:
+            with lock:
+                loads[remote_host] = record
+
+    threads = []
+    for remote_host in remote_hosts:
+        thread = threading.Thread(target=query, args=(remote_host,))
+        thread.daemon = True # Late hosts must not hold the launch
+        thread.start()
+        threads.append(thread)
+    deadline = monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - monotonic()))
+    with lock:
+        return dict(loads)
+
+def score(record, min_free=0):
+    """Sort key of a load record, the least loaded first: hosts with less
+    than min_free MiB available go last, then runnable processes and
+    kernels per CPU, then more available memory.
+
+    """
+
+    return (record["free"] < min_free,
+            (record["load"] + record["kernels"]) / float(record["cpus"]),
+            -record["free"])
+
+def select_host(remote_hosts, kernels_location, timeout, min_free=0):
+    """Return (the least loaded remote host, {remote host: load record}).
+    The first host is returned if no host answered in time.
+
+    """
+
+    remote_hosts = split_hosts(remote_hosts)
+    if len(remote_hosts) < 2:
+        return remote_hosts[0], {}
+    loads = host_loads(remote_hosts, kernels_location, timeout)
+    if not loads:
+        return remote_hosts[0], loads
+    return min(loads, key=lambda remote_host: (score(loads[remote_host],
+            min_free), remote_hosts.index(remote_host))), loads
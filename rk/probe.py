@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Reachability, passwordless auth and handshake time of remote hosts
+
+Every remote host is probed with `rk.ssh.try_passwordless_ssh` from a
+bounded thread pool, so a fleet of hosts takes about as long as its slowest
+host. Results are kept in a JSON cache, one record per remote host:
+
+* ``checked`` -- when the host was probed (seconds since the epoch),
+* ``reachable`` -- whether an SSH connection was made,
+* ``auth`` -- whether the login worked without a password,
+* ``rtt`` -- connection, handshake and auth time in seconds, or None,
+* ``error`` -- why the host is unreachable, or None.
+
+"""
+
+from json import dumps, load
+from time import time
+
+try:
+    from time import monotonic
+except ImportError: # Python 2
+    monotonic = time
+
+def probe_host(remote_host, timeout=None, keyfile=None):
+    """Probe one remote host, return its record"""
+
+    from rk.ssh import tunnel
+
+    record = {"checked": time(), "reachable": False, "auth": False,
+              "rtt": None, "error": None}
+    started = monotonic()
+    try:
+        auth = tunnel.try_passwordless_ssh(remote_host, keyfile,
+                paramiko=tunnel.paramiko != None, timeout=timeout,
+                cache=False)
+    except Exception as exception:
+        record["error"] = str(exception) or exception.__class__.__name__
+        return record
+    record["reachable"] = True
+    record["auth"] = auth
+    record["rtt"] = round(monotonic() - started, 6)
+    return record
+
+def probe_hosts(remote_hosts, workers=32, timeout=None, keyfile=None):
+    """Probe remote hosts in parallel, return {remote host: record}"""
+
+    from rk.ssh import tunnel
+
+    remote_hosts = list(remote_hosts)
+    records = tunnel.map_hosts(lambda remote_host: probe_host(remote_host,
+                                       timeout, keyfile),
+                               remote_hosts, workers)
+    return dict(zip(remote_hosts, records))
+
+def load_probes(path):
+    """Return the cached {remote host: record}, empty if no cache"""
+
+    try:
+        with open(path, 'r') as f:
+            return load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_probes(path, probes):
+    """Write the cache; hosts are probed again without it"""
+
+    from rk.files import replace_file
+
+    try:
+        replace_file(path, dumps(probes, indent=1, sort_keys=True))
+    except (IOError, OSError):
+        pass
+
+def is_fresh(record, ttl):
+    """Whether a record was probed less than ttl seconds ago"""
+
+    return record != None and time() - record.get("checked", 0) < ttl
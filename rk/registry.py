@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""Cached, indexed kernels dict
+
+Parsing a big ``kernels.json`` on every command is slow, so rk keeps a
+compact index of it in a cache file, rebuilt when ``kernels.json`` changes
+its modification time, size or inode. The index has two marshal sections:
+
+* sorted kernel names, their display names and host/language indexes (as
+  positions in the names list), enough for ``rk list`` and its filters,
+* the full kernel dicts, only loaded when a command needs them.
+
+"""
+
+import marshal
+import sys
+from bisect import bisect_left
+from os import stat
+from os.path import abspath, expanduser, join
+from zlib import crc32
+from struct import calcsize, pack, unpack
+
+cache_magic = b"rkix"
+cache_version = 1
+header_format = "<4sIQ" # Magic, version, size of the first section
+
+class Registry(object):
+    """Kernels dict with prefix, host and language lookups"""
+
+    def __init__(self, path, cache_location=None):
+        self.path = path
+        self.cache_location = cache_location
+        self.names = [] # Sorted kernel names
+        self.display_names = [] # Display names, in the names order
+        self.hosts = {} # Remote host: positions in names
+        self.languages = {} # Language: positions in names
+        self._kernels = None # Kernel name: kernel dict, loaded on demand
+        self.load()
+
+    def __contains__(self, kernel_name):
+        return self.position(kernel_name) != None
+
+    def __getitem__(self, kernel_name):
+        return self.kernels[kernel_name]
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def kernels(self):
+        """Full kernel dicts"""
+
+        if self._kernels == None:
+            try:
+                with open(self.cache_path(), 'rb') as f:
+                    f.seek(self.read_header(f), 1)
+                    kernels = marshal.loads(f.read())
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                kernels = None
+            if kernels == None or len(kernels) != len(self.names):
+                from json import load
+
+                with open(self.path, 'r') as f:
+                    kernels = load(f)
+            self._kernels = kernels
+        return self._kernels
+
+    def position(self, kernel_name):
+        """Position of kernel_name in names, or None"""
+
+        i = bisect_left(self.names, kernel_name)
+        if i < len(self.names) and self.names[i] == kernel_name:
+            return i
+        return None
+
+    def display_name(self, kernel_name):
+        return self.display_names[self.position(kernel_name)]
+
+    def cache_path(self):
+        """Cache file path for this kernels dict and Python version"""
+
+        name = "%08x" % (crc32(abspath(self.path).encode("utf-8")) &
+                        0xffffffff)
+        version = "%s%s" % sys.version_info[:2]
+        return join(expanduser(self.cache_location),
+                    "kernels-%s-py%s.idx" % (name, version))
+
+    def signature(self):
+        """Identify the current kernels.json contents"""
+
+        st = stat(self.path)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def read_header(self, f):
+        """Check the cache file header, return the first section size"""
+
+        header = f.read(calcsize(header_format))
+        if len(header) != calcsize(header_format):
+            raise ValueError("truncated cache")
+        magic, version, size = unpack(header_format, header)
+        if magic != cache_magic or version != cache_version:
+            raise ValueError("not a current cache")
+        return size
+
+    def load(self):
+        """Load the index from cache, or from kernels.json"""
+
+        signature = self.signature()
+        if self.cache_location != None:
+            try:
+                with open(self.cache_path(), 'rb') as f:
+                    index = marshal.loads(f.read(self.read_header(f)))
+                if index[0] == signature:
+                    (self.names, self.display_names, self.hosts,
+                     self.languages) = index[1:]
+                    return
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                pass
+        from json import load
+
+        with open(self.path, 'r') as f:
+            self._kernels = load(f)
+        self.index()
+        if self.cache_location != None:
+            self.save(signature)
+
+    def index(self):
+        """Build sorted names and host/language indexes"""
+
+        self.names = sorted(self._kernels)
+        self.display_names = []
+        self.hosts = {}
+        self.languages = {}
+        for i, kernel_name in enumerate(self.names):
+            kernel = self._kernels[kernel_name]
+            self.display_names.append(kernel.get("display_name"))
+            remote_hosts = kernel.get("remote_host")
+            if not isinstance(remote_hosts, list):
+                remote_hosts = [remote_hosts]
+            for remote_host in remote_hosts:
+                self.hosts.setdefault(remote_host, []).append(i)
+            self.languages.setdefault(kernel.get("language"), []).append(i)
+
+    def save(self, signature):
+        """Write the cache; without it, the next command parses kernels
+        dict again
+
+        """
+
+        from rk.files import replace_file
+
+        try:
+            index = marshal.dumps((signature, self.names, self.display_names,
+                                   self.hosts, self.languages))
+            replace_file(self.cache_path(),
+                         [pack(header_format, cache_magic, cache_version,
+                               len(index)), index,
+                          marshal.dumps(self._kernels)])
+        except (IOError, OSError, ValueError):
+            pass
+
+    def find(self, prefix=None, host=None, language=None):
+        """Return sorted kernel names matching all given filters
+
+        host matches a "remote_host" value, or its host part, so
+        "192.168.0.1" also matches "albert@192.168.0.1".
+
+        """
+
+        if prefix:
+            start = bisect_left(self.names, prefix)
+            end = start
+            while end < len(self.names) and self.names[end].startswith(prefix):
+                end += 1
+            positions = range(start, end)
+        else:
+            positions = range(len(self.names))
+        if host != None:
+            host_positions = set()
+            for remote_host, kernel_positions in self.hosts.items():
+                if remote_host != None and (remote_host == host or
+                        remote_host.split('@')[-1] == host):
+                    host_positions.update(kernel_positions)
+            positions = [i for i in positions if i in host_positions]
+        if language != None:
+            language_positions = set(self.languages.get(language, []))
+            positions = [i for i in positions if i in language_positions]
+        return [self.names[i] for i in positions]
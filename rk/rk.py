@@ -2,73 +2,139 @@
 
 from argparse import ArgumentParser
 from errno import EACCES, ENOTDIR
-from getpass import getuser
+from getpass import getpass, getuser
 from json import dumps, load
-from os import link, listdir, makedirs, remove, strerror
-from os.path import dirname, exists, expanduser, isdir, isfile, join
+from os import link, listdir, makedirs, remove, rename, strerror
+from os.path import (dirname, exists, expanduser, isdir, isfile, join,
+                     samefile)
 from shutil import copyfile, rmtree
-from subprocess import call
-from sys import argv, exit
+from sys import argv, exit, stderr, stdin
 
-from configobj import ConfigObj
+from rk.catalog import load_catalog
+
+# Modules needed by a few subcommands only are imported in those functions,
+# to keep startup fast.
 
 module_location = dirname(__file__)
-config_rk_abs_path = join(module_location, "config/rk.ini")
-config = ConfigObj(config_rk_abs_path)
+catalog = load_catalog(module_location) # Compiled config files
+config = catalog["config"]
 
 argparse = {} # Strings for -h --help
 messages = {} # Strings for output
 
-def create_dictionaries():
-    """Create "argparse" and "messages" dictionaries"""
+def authorize_remote_hosts(args, pri_key_abs_path):
+    """Install the public key on many remote hosts in parallel"""
 
-    config_argparse_rel_path = config["config_argparse_rel_path"]
-    config_argparse_abs_path = join(module_location, config_argparse_rel_path)
-    config_messages_rel_path = config["config_messages_rel_path"]
-    config_messages_abs_path = join(module_location, config_messages_rel_path)
-    with open(config_argparse_abs_path, 'r') as f:
-        argparse_list = f.read().splitlines()
-    for i in range(0, len(argparse_list), 2):
-        argparse[argparse_list[i]] = argparse_list[i+1]
-    with open(config_messages_abs_path, 'r') as f:
-        messages_list = f.read().splitlines()
-    for i in range(0, len(messages_list), 2):
-        messages[messages_list[i]] = messages_list[i+1]
+    from rk.authorize import install_keys
+    from rk.probe import load_probes, probe_hosts, save_probes
 
-def install_all(args):
-    """Install all remote jupyter kernels from kernels dict"""
+    remote_hosts = list(args.remote_hosts)
+    if args.all:
+        registry = load_registry()
+        remote_hosts += [h for h in sorted(registry.hosts)
+                         if h != None and h not in remote_hosts]
+    workers = args.workers or int(config["probe_workers"])
+    timeout = args.timeout or int(config["probe_timeout"])
+    # Skip remote hosts that accept the key already
+    results = probe_hosts(remote_hosts, workers, timeout, pri_key_abs_path)
+    new_remote_hosts = [h for h in remote_hosts
+                        if results[h]["reachable"] and not results[h]["auth"]]
+    errors = {}
+    if new_remote_hosts:
+        if stdin.isatty():
+            password = getpass(messages["_ask_password"] %
+                               len(new_remote_hosts))
+        else:
+            password = stdin.readline().rstrip('\n')
+        with open(pri_key_abs_path + ".pub", 'r') as f:
+            public_key = f.read()
+        errors = install_keys(new_remote_hosts, public_key, password, workers,
+                              timeout)
+        # Check the installed keys, for the table and the probe cache
+        installed = [h for h in new_remote_hosts if errors[h] == None]
+        results.update(probe_hosts(installed, workers, timeout,
+                                   pri_key_abs_path))
+    probes = load_probes(probe_cache_path())
+    probes.update(results)
+    save_probes(probe_cache_path(), probes)
+    # Print table of results
+    counts = [0, 0, 0, 0] # Installed, already authorized, failed,
+                          # unreachable
+    width = max(len(h) for h in remote_hosts) if remote_hosts else 0
+    for remote_host in remote_hosts:
+        record = results[remote_host]
+        if not record["reachable"]:
+            counts[3] += 1
+            status = messages["_probe_unreachable"] % record["error"]
+        elif remote_host not in errors:
+            counts[1] += 1
+            status = messages["_authorized_already"]
+        elif errors[remote_host] != None:
+            counts[2] += 1
+            status = messages["_authorized_failed"] % errors[remote_host]
+        elif not record["auth"]:
+            counts[2] += 1
+            status = messages["_authorized_failed"] % \
+                    messages["_authorized_no_login"]
+        else:
+            counts[0] += 1
+            status = messages["_authorized"]
+        print("%-*s  %s" % (width, remote_host, status))
+    print(messages["_authorized_summary"] % tuple(counts))
+    if counts[2] or counts[3]:
+        exit(1)
 
-    config_kernels_rel_path = config["config_kernels_rel_path"]
-    config_kernels_abs_path = join(module_location, config_kernels_rel_path)
-    # Load kernels.json file
-    with open(config_kernels_abs_path, 'r') as f:
-        kernels_dict = load(f)
-    # Create kernels list from kernels dict
-    kernels_list = [k for k in kernels_dict.keys()]
-    # Sort kernels list
-    kernels_list.sort()
-    # Install remote jupyter kernels
-    args.kernel_names = kernels_list
-    install_kernel(args)
+def copy_logos(img_location, logo_name_srt, destination):
+    """Copy logos"""
 
-def install_kernel(args):
-    """Install remote jupyter kernel/kernels"""
+    for size in ["32", "64"]:
+        logo_abs_path_str = join(join(module_location, img_location),
+                                 logo_name_srt)
+        logo_abs_path = logo_abs_path_str.format(size)
+        logo_name = logo_name_srt.format(size)
+        if exists(logo_abs_path) and isfile(logo_abs_path):
+            try:
+                link(logo_abs_path, join(destination, logo_name))
+            except Exception:
+                try:
+                    copyfile(logo_abs_path, join(destination, logo_name))
+                except Exception as exception: # Python3 PermissionError
+                    error_code = exception.errno
+                    if error_code == EACCES: # 13
+                        print(messages["_error_NoRoot"])
+                        exit(1)
+                    else:
+                        print(messages["_error_Oops"] %
+                                strerror(error_code))
+                        exit(1)
 
-    def copy_logos(img_location, logo_name_srt, destination):
-        """Copy logos"""
+def create_dictionaries():
+    """Create "argparse" and "messages" dictionaries"""
 
-        for size in ["32", "64"]:
-            logo_abs_path_str = join(join(module_location, img_location),
-                                     logo_name_srt)
-            logo_abs_path = logo_abs_path_str.format(size)
-            logo_name = logo_name_srt.format(size)
-            if exists(logo_abs_path) and isfile(logo_abs_path):
-                try:
-                    link(logo_abs_path, join(destination, logo_name))
-                except Exception:
+    argparse.update(catalog["argparse"])
+    messages.update(catalog["messages"])
+
+def create_directory(directory_name, mode=0o777):
+    """Recursive directory creation function
+    os.chmod work only for last directory
+
+    """
+
+    try:
+        makedirs(directory_name, mode)
+    except Exception as exception:
+        error_code = exception.errno
+        if error_code == EACCES: # 13 (Python3 PermissionError)
+            print(messages["_error_NoRoot"])
+            exit(1)
+        elif error_code == ENOTDIR: # 20 (Python3 NotADirectoryError)
+            path = directory_name
+            while path != '/':
+                if isfile(path):
                     try:
-                        copyfile(logo_abs_path, join(destination, logo_name))
-                    except Exception as exception: # Python3 PermissionError
+                        remove(path)
+                    except Exception as exception: # Python3
+                                                   # PermissionError
                         error_code = exception.errno
                         if error_code == EACCES: # 13
                             print(messages["_error_NoRoot"])
@@ -77,126 +143,163 @@ def install_kernel(args):
                             print(messages["_error_Oops"] %
                                     strerror(error_code))
                             exit(1)
+                path = dirname(path)
+            try:
+                makedirs(directory_name, mode)
+            except Exception as exception: # Python3 PermissionError
+                error_code = exception.errno
+                if error_code == EACCES: # 13
+                    print(messages["_error_NoRoot"])
+                    exit(1)
+                else:
+                    print(messages["_error_Oops"] % strerror(error_code))
+                    exit(1)
+        else:
+            print(messages["_error_Oops"] % strerror(error_code))
+            exit(1)
 
-    def create_directory(directory_name, mode=0o777):
-        """Recursive directory creation function
-        os.chmod work only for last directory
+def create_kernel_json_file(kernel, destination):
+    """Create kernel.json file"""
 
-        """
+    try:
+        with open(join(destination, "kernel.json"), 'w') as f:
+            f.write(kernel_json(kernel))
+    except Exception as exception: # Python3 PermissionError
+        error_code = exception.errno
+        if error_code == EACCES: # 13
+            print(messages["_error_NoRoot"])
+            exit(1)
+        else:
+            print(messages["_error_Oops"] % strerror(error_code))
+            exit(1)
+
+def discover_interpreters(args):
+    """Find interpreters with ipykernel on remote hosts, print kernels dict
+    entries for them or merge them into kernels dict
+
+    """
+
+    from rk.discover import discover_hosts, kernel_entries
+    from rk.probe import is_fresh, load_probes, save_probes
+
+    remote_hosts = args.remote_hosts
+    if not remote_hosts:
+        registry = load_registry()
+        remote_hosts = sorted(h for h in registry.hosts if h != None)
+    # Remote hosts with a fresh result are not searched again, failed ones
+    # are
+    path = join(expanduser(config["rk_cache_location"]),
+                config["discover_cache_file_name"])
+    discoveries = load_probes(path)
+    ttl = int(config["discover_ttl"])
+    stale = [h for h in remote_hosts if args.refresh or
+             not is_fresh(discoveries.get(h), ttl) or
+             discoveries[h]["error"] != None]
+    workers = args.workers or int(config["probe_workers"])
+    timeout = args.timeout or int(config["discover_timeout"])
+    discoveries.update(discover_hosts(stale, workers, timeout))
+    save_probes(path, discoveries)
+    entries = {}
+    failed = 0
+    for remote_host in remote_hosts:
+        record = discoveries[remote_host]
+        if record["error"] != None:
+            failed += 1
+            stderr.write(messages["_discover_failed"] % (remote_host,
+                         record["error"]) + '\n')
+            continue
+        entries.update(kernel_entries(remote_host, record["interpreters"]))
+    if not args.merge:
+        print(dumps(entries, indent=1, sort_keys=True))
+        return
+    # Add the new kernels to kernels dict, keep the ones already there
+    config_kernels_abs_path = join(module_location,
+                                   config["config_kernels_rel_path"])
+    with open(config_kernels_abs_path, 'r') as f:
+        kernels_dict = load(f)
+    added = [k for k in sorted(entries) if k not in kernels_dict]
+    for kernel_name in added:
+        kernels_dict[kernel_name] = entries[kernel_name]
+    if added:
+        from rk.files import replace_file
 
         try:
-            makedirs(directory_name, mode)
-        except Exception as exception:
-            error_code = exception.errno
-            if error_code == EACCES: # 13 (Python3 PermissionError)
-                print(messages["_error_NoRoot"])
-                exit(1)
-            elif error_code == ENOTDIR: # 20 (Python3 NotADirectoryError)
-                path = directory_name
-                while path != '/':
-                    if isfile(path):
-                        try:
-                            remove(path)
-                        except Exception as exception: # Python3
-                                                       # PermissionError
-                            error_code = exception.errno
-                            if error_code == EACCES: # 13
-                                print(messages["_error_NoRoot"])
-                                exit(1)
-                            else:
-                                print(messages["_error_Oops"] %
-                                        strerror(error_code))
-                                exit(1)
-                    path = dirname(path)
-                try:
-                    makedirs(directory_name, mode)
-                except Exception as exception: # Python3 PermissionError
-                    error_code = exception.errno
-                    if error_code == EACCES: # 13
-                        print(messages["_error_NoRoot"])
-                        exit(1)
-                    else:
-                        print(messages["_error_Oops"] % strerror(error_code))
-                        exit(1)
-            else:
-                print(messages["_error_Oops"] % strerror(error_code))
-                exit(1)
-
-    def create_kernel_json_file(display_name, language, script, interpreter,
-                                connection_file, remote_host, destination):
-        """Create kernel.json file"""
-
-        kernel_dict = {"argv": [], "display_name": display_name,
-                       "language": language}
-        kernel_dict["argv"].append(script)
-        kernel_dict["argv"].append(interpreter)
-        kernel_dict["argv"].append(connection_file)
-        kernel_dict["argv"].append(remote_host)
-        try:
-            with open(join(destination, "kernel.json"), 'w') as f:
-                f.write(dumps(kernel_dict, indent=1, sort_keys=True))
-        except Exception as exception: # Python3 PermissionError
-            error_code = exception.errno
-            if error_code == EACCES: # 13
-                print(messages["_error_NoRoot"])
-                exit(1)
-            else:
-                print(messages["_error_Oops"] % strerror(error_code))
-                exit(1)
+            replace_file(config_kernels_abs_path,
+                         dumps(kernels_dict, indent=1, sort_keys=True) + '\n')
+        except (IOError, OSError) as exception:
+            exit_with_error(exception)
+    print(messages["_discovered"] % (len(added), len(entries) - len(added),
+                                     failed))
+
+def exit_with_error(exception):
+    """Print error message for OSError/IOError exception and exit"""
+
+    error_code = exception.errno
+    if error_code == EACCES: # 13 (Python3 PermissionError)
+        print(messages["_error_NoRoot"])
+    else:
+        print(messages["_error_Oops"] % strerror(error_code))
+    exit(1)
+
+def gc_sessions(args):
+    """Tear down tunnels and remote kernels of dead sessions"""
+
+    from rk.sessions import is_running, load_sessions, teardown_sessions
+
+    location = expanduser(config["rk_sessions_location"])
+    records = load_sessions(location)
+    dead_records = [r for r in records if not is_running(r)]
+    if args.dry_run:
+        for record in dead_records:
+            print(messages["_gc_dead"] % (record["session"],
+                                          record["remote_host"]))
+        return
+    errors = teardown_sessions(dead_records, location,
+                               int(config["probe_workers"]),
+                               int(config["probe_timeout"]))
+    failed = 0
+    for record in dead_records:
+        error = errors[record["session"]]
+        if error == None:
+            print(messages["_gc_removed"] % (record["session"],
+                                             record["remote_host"]))
+        else:
+            failed += 1
+            print(messages["_gc_failed"] % (record["session"],
+                                            record["remote_host"], error))
+    print(messages["_gc"] % (len(dead_records) - failed, failed,
+                             len(records) - len(dead_records)))
+    if failed:
+        exit(1)
+
+def install_all(args):
+    """Install all remote jupyter kernels from kernels dict"""
+
+    registry = load_registry()
+    # Install remote jupyter kernels
+    args.kernel_names = list(registry.names)
+    install_kernel(args, registry)
+
+def install_kernel(args, kernels_dict=None):
+    """Install remote jupyter kernel/kernels"""
 
     kernels_location = config["kernels_location"]
     if '~' in kernels_location:
         kernels_location = expanduser(kernels_location)
-    img_location = config["img_location"]
-    logo_name_srt = config["logo_name_srt"]
-    script = config["script"]
-    connection_file = config["connection_file"]
-    config_kernels_rel_path = config["config_kernels_rel_path"]
-    config_kernels_abs_path = join(module_location,
-                                   config_kernels_rel_path)
     kernel_names = args.kernel_names
     if kernel_names == None:
         # Install template of remote kernel
         kernel_name = config["kernel_name"]
-        display_name = config["display_name"]
-        language = config["language"]
-        interpreter = config["interpreter"]
-        remote_host = config["remote_host"]
-        kernel_abs_path = join(kernels_location, kernel_name)
-        if exists(kernel_abs_path) and isfile(kernel_abs_path):
-            try:
-                remove(kernel_abs_path)
-            except Exception as exception: # Python3 PermissionError
-                error_code = exception.errno
-                if error_code == EACCES: # 13
-                    print(messages["_error_NoRoot"])
-                    exit(1)
-                else:
-                    print(messages["_error_Oops"] % strerror(error_code))
-                    exit(1)
-        if not exists(kernel_abs_path):
-            # Create directory
-            create_directory(kernel_abs_path, 0o755)
-            # Copy logos
-            copy_logos(img_location, logo_name_srt, kernel_abs_path)
-            # Create kernel.json
-            create_kernel_json_file(display_name, language, script,
-                                    interpreter, connection_file,
-                                    remote_host, kernel_abs_path)
-            print(messages["_installed_template"])
-        else:
-            print(messages["_delete_template"])
-            answer = raw_input()
-            answer_lower = answer.lower()
-            if ((answer_lower == 'y') or (answer_lower == 'yes') or
-                    (answer_lower == 'yep')):
-                uninstall_kernel(args)
-                install_kernel(args)
+        kernels_dict = {kernel_name: {"display_name": config["display_name"],
+                                      "interpreter": config["interpreter"],
+                                      "language": config["language"],
+                                      "remote_host": config["remote_host"]}}
+        kernel_names = [kernel_name]
+        delete_message = messages["_delete_template"]
     else:
         # Install kernel/kernels
-        # Load kernels.json file
-        with open(config_kernels_abs_path, 'r') as f:
-            kernels_dict = load(f)
+        if kernels_dict == None:
+            kernels_dict = load_registry()
         # Check kernel_names list/
         no_kernel_names = []
         for kernel_name in kernel_names:
@@ -210,42 +313,140 @@ def install_kernel(args):
                         '\' \''.join(no_kernel_names))
             exit(1)
         # /Check kernel_names list
+        kernel_names = sorted(set(kernel_names), key=kernel_names.index)
+        delete_message = messages["_delete"]
+    # Ask about existing kernels before changing anything, unless --yes
+    if not args.yes:
+        answered_no = []
         for kernel_name in kernel_names:
-            display_name = kernels_dict[kernel_name]["display_name"]
-            language = kernels_dict[kernel_name]["language"]
-            interpreter = kernels_dict[kernel_name]["interpreter"]
-            remote_host = kernels_dict[kernel_name]["remote_host"]
-            kernel_abs_path = join(kernels_location, kernel_name)
-            if exists(kernel_abs_path) and isfile(kernel_abs_path):
-                try:
-                    remove(kernel_abs_path)
-                except Exception as exception: # Python3 PermissionError
-                    error_code = exception.errno
-                    if error_code == EACCES: # 13
-                        print(messages["_error_NoRoot"])
-                        exit(1)
-                    else:
-                        print(messages["_error_Oops"] % strerror(error_code))
-                        exit(1)
-            if not exists(kernel_abs_path):
-                # Create directory
-                create_directory(kernel_abs_path, 0o755)
-                # Copy logos
-                copy_logos(img_location, logo_name_srt, kernel_abs_path)
-                # Create kernel.json
-                create_kernel_json_file(display_name, language, script,
-                                        interpreter, connection_file,
-                                        remote_host, kernel_abs_path)
-                print(messages["_installed"] % kernel_name)
-            else:
-                print(messages["_delete"] % kernel_name)
+            if isdir(join(kernels_location, kernel_name)):
+                if '%s' in delete_message:
+                    print(delete_message % kernel_name)
+                else:
+                    print(delete_message)
                 answer = raw_input()
                 answer_lower = answer.lower()
-                if ((answer_lower == 'y') or (answer_lower == 'yes') or
+                if not ((answer_lower == 'y') or (answer_lower == 'yes') or
                         (answer_lower == 'yep')):
-                    args.kernel_names = [kernel_name]
-                    uninstall_kernel(args)
-                    install_kernel(args)
+                    answered_no.append(kernel_name)
+        kernel_names = [k for k in kernel_names if k not in answered_no]
+    if len(kernel_names) == 0:
+        return
+    install_kernels(kernel_names, kernels_dict, kernels_location)
+    if args.kernel_names == None:
+        print(messages["_installed_template"])
+    else:
+        for kernel_name in kernel_names:
+            print(messages["_installed"] % kernel_name)
+
+def install_kernels(kernel_names, kernels_dict, kernels_location):
+    """Install kernels as one transaction
+
+    Every kernel directory is built in a staging dir under kernels location,
+    then renamed into place. Existing kernels are renamed aside first, and
+    are renamed back if anything fails, so a failure leaves kernels location
+    as it was.
+
+    """
+
+    from tempfile import mkdtemp
+
+    from rk.kernelspecs import (empty_trash_later, load_owned, move_to_trash,
+                                save_owned)
+
+    img_location = config["img_location"]
+    logo_name_srt = config["logo_name_srt"]
+    if not exists(kernels_location):
+        create_directory(kernels_location, 0o755)
+    # Kernels installed by rk so far, before the new ones are in place
+    owned = load_owned(kernels_location, config["script"])
+    try:
+        # Same filesystem as kernels location, so renames are atomic
+        staging = mkdtemp(prefix=".rk-staging-", dir=kernels_location)
+    except (IOError, OSError) as exception:
+        exit_with_error(exception)
+    new_location = join(staging, "new")
+    old_location = join(staging, "old")
+    replaced = [] # Kernels renamed into place: (new path, old path or None)
+    try:
+        # Build all kernel directories
+        for kernel_name in kernel_names:
+            kernel_abs_path = join(new_location, kernel_name)
+            create_directory(kernel_abs_path, 0o755)
+            copy_logos(img_location, logo_name_srt, kernel_abs_path)
+            create_kernel_json_file(kernels_dict[kernel_name],
+                                    kernel_abs_path)
+        # Swap them in
+        create_directory(old_location, 0o755)
+        for kernel_name in kernel_names:
+            kernel_abs_path = join(kernels_location, kernel_name)
+            old_abs_path = None
+            if exists(kernel_abs_path):
+                old_abs_path = join(old_location, kernel_name)
+                rename(kernel_abs_path, old_abs_path)
+            rename(join(new_location, kernel_name), kernel_abs_path)
+            replaced.append((kernel_abs_path, old_abs_path))
+    except BaseException as exception:
+        # Roll back
+        for kernel_abs_path, old_abs_path in reversed(replaced):
+            rmtree(kernel_abs_path, ignore_errors=True)
+            if old_abs_path != None:
+                rename(old_abs_path, kernel_abs_path)
+        rmtree(staging, ignore_errors=True)
+        if isinstance(exception, (IOError, OSError)):
+            exit_with_error(exception)
+        raise
+    # Record the kernels as rk's, in the manifest. Delete replaced kernels
+    # in the background.
+    try:
+        save_owned(kernels_location, owned.union(kernel_names))
+        move_to_trash(kernels_location, [staging])
+    except (IOError, OSError) as exception:
+        exit_with_error(exception)
+    empty_trash_later(kernels_location)
+
+def kernel_json(kernel):
+    """Return kernel.json file contents for a kernel from kernels dict"""
+
+    kernel_dict = {"argv": [], "display_name": kernel["display_name"],
+                   "language": kernel["language"]}
+    kernel_dict["argv"].append(config["script"])
+    kernel_dict["argv"].append(kernel["interpreter"])
+    kernel_dict["argv"].append(config["connection_file"])
+    remote_host = kernel["remote_host"]
+    if isinstance(remote_host, list):
+        remote_host = ",".join(remote_host) # A pool, see rk.placement
+    kernel_dict["argv"].append(remote_host)
+    # Optional SSH transport settings, as rkscript flags
+    ssh = kernel.get("ssh", {})
+    for key in ("ciphers", "macs"):
+        if ssh.get(key):
+            kernel_dict["argv"].append("--%s=%s" % (key, ",".join(ssh[key])))
+    if ssh.get("compression") != None:
+        kernel_dict["argv"].append("--compression=%s" %
+                                   ("yes" if ssh["compression"] else "no"))
+    # Optional working directory sync: true, or a dict of settings
+    sync = kernel.get("sync")
+    if sync is True or isinstance(sync, dict):
+        kernel_dict["argv"].append("--sync")
+    if isinstance(sync, dict):
+        if sync.get("ignore") != None:
+            kernel_dict["argv"].append("--sync-ignore=%s" %
+                                       ",".join(sync["ignore"]))
+        for key in ("max_file_size", "max_size"):
+            if sync.get(key) != None:
+                kernel_dict["argv"].append("--sync-%s=%s" % (
+                        key.replace('_', '-'), sync[key]))
+    return dumps(kernel_dict, indent=1, sort_keys=True)
+
+def load_registry():
+    """Load kernels dict through the cached registry index"""
+
+    from rk.registry import Registry
+
+    config_kernels_rel_path = config["config_kernels_rel_path"]
+    config_kernels_abs_path = join(module_location, config_kernels_rel_path)
+    return Registry(config_kernels_abs_path, config["rk_cache_location"])
 
 def main():
     """Main function"""
@@ -254,6 +455,57 @@ def main():
     args = parse_command_line_args()
     args.function_name(args)
 
+def manage_agents(args):
+    """Start/stop warm remote kernel agents"""
+
+    from inspect import getsource
+
+    from execnet import makegateway
+
+    from rk import agent
+
+    kernels_dict = load_registry()
+    kernel_names = args.kernel_names
+    # Check kernel_names list/
+    no_kernel_names = []
+    for kernel_name in kernel_names:
+        if kernel_name not in kernels_dict:
+            no_kernel_names.append(kernel_name)
+    if len(no_kernel_names) != 0:
+        if len(no_kernel_names) == 1:
+            print(messages["_error_NoKernel"] % no_kernel_names[0])
+        else:
+            print(messages["_error_NoKernels"] %
+                    '\' \''.join(no_kernel_names))
+        exit(1)
+    # /Check kernel_names list
+    command = "stop" if args.stop else "start"
+    modules = [m.strip() for m in config["agent_modules"].split(',')
+               if m.strip()]
+    # One agent per remote host and interpreter
+    agents = []
+    for kernel_name in kernel_names:
+        remote_hosts = kernels_dict[kernel_name]["remote_host"]
+        if not isinstance(remote_hosts, list):
+            remote_hosts = [remote_hosts]
+        interpreter = kernels_dict[kernel_name]["interpreter"]
+        for remote_host in remote_hosts: # Every host of a pool
+            if (remote_host, interpreter) not in agents:
+                agents.append((remote_host, interpreter))
+    for remote_host, interpreter in agents:
+        gw = makegateway("ssh=%s//python=%s" % (remote_host, interpreter))
+        ch = gw.remote_exec(getsource(agent) + "\nmain(channel)\n")
+        ch.send({"command": command, "modules": modules})
+        pid = ch.receive()
+        gw.exit()
+        agent_name = "%s//%s" % (remote_host, interpreter)
+        if pid is None:
+            print(messages["_agent_not_running"] % agent_name)
+        elif command == "start":
+            print(messages["_agent_started"] % (agent_name, pid))
+        else:
+            print(messages["_agent_stopped"] % (agent_name, pid))
+
 def parse_command_line_args():
     """Parse command line arguments"""
 
@@ -268,6 +520,12 @@ def parse_command_line_args():
     parser_list = subparsers.add_parser("list",
             description=argparse["_parser_list"],
             help=argparse["_parser_list"])
+    parser_list.add_argument("--prefix", action="store",
+                             help=argparse["_parser_list_prefix"])
+    parser_list.add_argument("--host", action="store",
+                             help=argparse["_parser_list_host"])
+    parser_list.add_argument("--language", action="store",
+                             help=argparse["_parser_list_language"])
     parser_list.set_defaults(function_name=show_kernels_list)
     # Create the parser for the "install" subcommand
     parser_install = subparsers.add_parser("install",
@@ -275,17 +533,23 @@ def parse_command_line_args():
             help=argparse["_parser_install"])
     parser_install.add_argument("kernel_names", action="store", nargs='+',
                                 metavar="KERNEL_NAME")
+    parser_install.add_argument("-y", "--yes", action="store_true",
+                                help=argparse["_parser_yes"])
     parser_install.set_defaults(function_name=install_kernel)
     # Create the parser for the "install-template" subcommand
     parser_install_template = subparsers.add_parser("install-template",
             description=argparse["_parser_install_template"],
             help=argparse["_parser_install_template"])
+    parser_install_template.add_argument("-y", "--yes", action="store_true",
+                                         help=argparse["_parser_yes"])
     parser_install_template.set_defaults(function_name=install_kernel,
                                          kernel_names=None)
     # Create the parser for the "install-all" subcommand
     parser_install_all = subparsers.add_parser("install-all",
             description=argparse["_parser_install_all"],
             help=argparse["_parser_install_all"])
+    parser_install_all.add_argument("-y", "--yes", action="store_true",
+                                    help=argparse["_parser_yes"])
     parser_install_all.set_defaults(function_name=install_all)
     # Create the parser for the "uninstall" subcommand
     parser_uninstall= subparsers.add_parser("uninstall",
@@ -305,24 +569,143 @@ def parse_command_line_args():
             description=argparse["_parser_uninstall_all"],
             help=argparse["_parser_uninstall_all"])
     parser_uninstall_all.set_defaults(function_name=uninstall_all)
+    # Create the parser for the "sync" subcommand
+    parser_sync = subparsers.add_parser("sync",
+            description=argparse["_parser_sync"],
+            help=argparse["_parser_sync"])
+    parser_sync.add_argument("-n", "--dry-run", action="store_true",
+                             help=argparse["_parser_sync_dry_run"])
+    parser_sync.set_defaults(function_name=sync_kernels)
+    # Create the parser for the "probe" subcommand
+    parser_probe = subparsers.add_parser("probe",
+            description=argparse["_parser_probe"],
+            help=argparse["_parser_probe"])
+    parser_probe.add_argument("remote_hosts", action="store", nargs='*',
+                              metavar="REMOTE_HOST",
+                              help=argparse["_parser_probe_hosts"])
+    parser_probe.add_argument("--stale", action="store_true",
+                              help=argparse["_parser_probe_stale"])
+    parser_probe.add_argument("-j", "--workers", action="store", type=int,
+                              help=argparse["_parser_probe_workers"])
+    parser_probe.add_argument("-t", "--timeout", action="store", type=int,
+                              help=argparse["_parser_probe_timeout"])
+    parser_probe.set_defaults(function_name=probe_remote_hosts)
+    # Create the parser for the "discover" subcommand
+    parser_discover = subparsers.add_parser("discover",
+            description=argparse["_parser_discover"],
+            help=argparse["_parser_discover"])
+    parser_discover.add_argument("remote_hosts", action="store", nargs='*',
+                                 metavar="REMOTE_HOST",
+                                 help=argparse["_parser_discover_hosts"])
+    parser_discover.add_argument("--merge", action="store_true",
+                                 help=argparse["_parser_discover_merge"])
+    parser_discover.add_argument("--refresh", action="store_true",
+                                 help=argparse["_parser_discover_refresh"])
+    parser_discover.add_argument("-j", "--workers", action="store",
+                                 type=int,
+                                 help=argparse["_parser_discover_workers"])
+    parser_discover.add_argument("-t", "--timeout", action="store", type=int,
+                                 help=argparse["_parser_discover_timeout"])
+    parser_discover.set_defaults(function_name=discover_interpreters)
+    # Create the parser for the "ps" subcommand
+    parser_ps = subparsers.add_parser("ps",
+            description=argparse["_parser_ps"],
+            help=argparse["_parser_ps"])
+    parser_ps.set_defaults(function_name=show_sessions)
+    # Create the parser for the "gc" subcommand
+    parser_gc = subparsers.add_parser("gc",
+            description=argparse["_parser_gc"],
+            help=argparse["_parser_gc"])
+    parser_gc.add_argument("-n", "--dry-run", action="store_true",
+                           help=argparse["_parser_gc_dry_run"])
+    parser_gc.set_defaults(function_name=gc_sessions)
     # Create the parser for the "ssh" subcommand
-    parser_list = subparsers.add_parser("ssh",
+    parser_ssh = subparsers.add_parser("ssh",
             description=argparse["_parser_ssh"],
             help=argparse["_parser_ssh"])
-    parser_list.set_defaults(function_name=setup_ssh_auto_login)
+    parser_ssh.add_argument("remote_hosts", action="store", nargs='*',
+                            metavar="REMOTE_HOST",
+                            help=argparse["_parser_ssh_hosts"])
+    parser_ssh.add_argument("--all", action="store_true",
+                            help=argparse["_parser_ssh_all"])
+    parser_ssh.add_argument("-j", "--workers", action="store", type=int,
+                            help=argparse["_parser_probe_workers"])
+    parser_ssh.add_argument("-t", "--timeout", action="store", type=int,
+                            help=argparse["_parser_probe_timeout"])
+    parser_ssh.set_defaults(function_name=setup_ssh_auto_login)
+    # Create the parser for the "agent" subcommand
+    parser_agent = subparsers.add_parser("agent",
+            description=argparse["_parser_agent"],
+            help=argparse["_parser_agent"])
+    parser_agent.add_argument("kernel_names", action="store", nargs='+',
+                              metavar="KERNEL_NAME")
+    parser_agent.add_argument("--stop", action="store_true",
+                              help=argparse["_parser_agent_stop"])
+    parser_agent.set_defaults(function_name=manage_agents)
     if len(argv) == 1:
         parser.print_help()
         exit(0) # Clean exit without any errors/problems
     return parser.parse_args()
 
+def probe_cache_path():
+    """Absolute path of the probe cache file"""
+
+    return join(expanduser(config["rk_cache_location"]),
+                config["probe_cache_file_name"])
+
+def probe_remote_hosts(args):
+    """Check remote hosts in parallel, update the probe cache"""
+
+    from rk.probe import is_fresh, load_probes, probe_hosts, save_probes
+
+    remote_hosts = args.remote_hosts
+    if not remote_hosts:
+        registry = load_registry()
+        remote_hosts = sorted(h for h in registry.hosts if h != None)
+    path = probe_cache_path()
+    probes = load_probes(path)
+    if args.stale:
+        ttl = int(config["probe_ttl"])
+        remote_hosts = [h for h in remote_hosts
+                        if not is_fresh(probes.get(h), ttl)]
+    workers = args.workers or int(config["probe_workers"])
+    timeout = args.timeout or int(config["probe_timeout"])
+    results = probe_hosts(remote_hosts, workers, timeout)
+    probes.update(results)
+    save_probes(path, probes)
+    # Print results
+    counts = [0, 0, 0] # Ok, without passwordless login, unreachable
+    for remote_host in remote_hosts:
+        record = results[remote_host]
+        if not record["reachable"]:
+            counts[2] += 1
+        elif not record["auth"]:
+            counts[1] += 1
+        else:
+            counts[0] += 1
+        print("%s: %s" % (remote_host, probe_status(record)))
+    print(messages["_probed"] % tuple(counts))
+
+def probe_status(record):
+    """Short health status of a probe cache record"""
+
+    if not record["reachable"]:
+        return messages["_probe_unreachable"] % record["error"]
+    elif not record["auth"]:
+        return messages["_probe_no_auth"] % (record["rtt"] * 1000)
+    return messages["_probe_ok"] % (record["rtt"] * 1000)
+
 def setup_ssh_auto_login(args):
     """Setup SSH for auto login without a password"""
 
+    from subprocess import call
+
     keys_location = "~/.ssh"
     pri_key_paths = ["~/.ssh/id_dsa", "~/.ssh/id_ecdsa", "~/.ssh/id_ed25519",
                      "~/.ssh/id_rsa"]
 
     # Check current keys
+    pri_key_abs_path = expanduser("~/.ssh/id_rsa")
     total_keys_flag = False
     pri_key_flag = False
     pub_key_flag = False
@@ -337,6 +720,7 @@ def setup_ssh_auto_login(args):
             total_keys_flag = True
             break
         else:
+            pri_key_abs_path = expanduser("~/.ssh/id_rsa")
             pri_key_flag = False
             pub_key_flag = False
     if total_keys_flag == False:
@@ -347,6 +731,10 @@ def setup_ssh_auto_login(args):
             makedirs(keys_dir)
         # Create a public and a private keys using the ssh-keygen command
         call("ssh-keygen -t rsa -b 4096 -N '' -f ~/.ssh/id_rsa", shell=True)
+    if args.remote_hosts or args.all:
+        # Batch mode
+        authorize_remote_hosts(args, pri_key_abs_path)
+        return
     # Ask about a remote machine
     print(messages["_ask_remote_host"])
     remote_username_at_remote_host = raw_input()
@@ -366,42 +754,176 @@ def setup_ssh_auto_login(args):
 def show_kernels_list(args):
     """Show list of remote jupyter kernels from kernels dict"""
 
-    config_kernels_rel_path = config["config_kernels_rel_path"]
-    config_kernels_abs_path = join(module_location, config_kernels_rel_path)
-    # Load kernels.json file
-    with open(config_kernels_abs_path, 'r') as f:
-        kernels_dict = load(f)
-    # Create kernels list from kernels dict
-    kernels_list = [k for k in kernels_dict.keys()]
-    # Sort kernels list
-    kernels_list.sort()
+    registry = load_registry()
+    # Sorted kernels list, optionally filtered
+    kernels_list = registry.find(prefix=args.prefix, host=args.host,
+                                 language=args.language)
+    # Health of remote hosts from the probe cache, if fresh
+    statuses = {} # Kernel name: statuses of its remote hosts
+    probes = {}
+    if exists(probe_cache_path()):
+        from rk.probe import is_fresh, load_probes
+
+        ttl = int(config["probe_ttl"])
+        probes = load_probes(probe_cache_path())
+    for remote_host in sorted(h for h in registry.hosts if h in probes):
+        record = probes[remote_host]
+        if is_fresh(record, ttl):
+            for i in registry.hosts[remote_host]:
+                statuses.setdefault(registry.names[i], []).append(
+                        probe_status(record))
     # Print kernels list
     for kernel in kernels_list:
-         print("%s (display name: \"%s\")" % (kernel,
-                 kernels_dict[kernel]["display_name"]))
+        if kernel in statuses:
+            print("%s (display name: \"%s\") [%s]" % (kernel,
+                    registry.display_name(kernel),
+                    "; ".join(statuses[kernel])))
+        else:
+            print("%s (display name: \"%s\")" % (kernel,
+                    registry.display_name(kernel)))
 
-def uninstall_all(args):
-    """Uninstall all jupyter kernels from kernels location"""
+def show_sessions(args):
+    """Show running and dead remote kernel sessions"""
+
+    from time import time
+
+    from rk.sessions import is_running, load_sessions
+
+    rows = [("SESSION", "REMOTE_HOST", "STATUS", "PIDS", "PORTS", "AGE")]
+    for record in load_sessions(expanduser(config["rk_sessions_location"])):
+        pids = "%s/%s<->%s" % (record["local_pid"], record["tunnel_pid"] or
+                               '-', record["remote_pid"])
+        ports = ",".join("%s<->%s" % tuple(pair)
+                         for pair in record["port_pairs"])
+        minutes = int(time() - record["started"]) // 60
+        rows.append((record["session"], record["remote_host"],
+                     "running" if is_running(record) else "dead", pids,
+                     ports, "%i:%02i" % divmod(minutes, 60)))
+    widths = [max(len(str(row[i])) for row in rows) for i in range(5)]
+    for row in rows:
+        print("  ".join(str(value).ljust(width) for value, width in
+                        zip(row, widths)) + "  " + row[5])
+
+def sync_kernels(args):
+    """Synchronize kernels location with kernels dict"""
+
+    from hashlib import sha1
+
+    from rk.kernelspecs import (empty_trash_later, load_owned, move_to_trash,
+                                update_owned)
 
     kernels_location = config["kernels_location"]
     if '~' in kernels_location:
         kernels_location = expanduser(kernels_location)
-    kernel_names = []
-    for element in listdir(kernels_location):
-        element_abs_path = join(kernels_location, element)
-        if isdir(element_abs_path):
+    img_location = join(module_location, config["img_location"])
+    logo_names = [config["logo_name_srt"].format(size)
+                  for size in ["32", "64"]]
+    registry = load_registry()
+    installed = set()
+    if isdir(kernels_location):
+        installed = set(element for element in listdir(kernels_location)
+                        if not element.startswith('.') and
+                        isdir(join(kernels_location, element)))
+
+    def same_file(path, source_path, source_digest):
+        """Compare an installed file with a source file by content"""
+
+        if not exists(source_path):
+            return not exists(path)
+        if not isfile(path):
+            return False
+        if samefile(path, source_path): # Hard link
+            return True
+        with open(path, 'rb') as f:
+            return sha1(f.read()).digest() == source_digest
+
+    # Source logo digests, computed once
+    logos = []
+    for logo_name in logo_names:
+        logo_abs_path = join(img_location, logo_name)
+        digest = None
+        if exists(logo_abs_path):
+            with open(logo_abs_path, 'rb') as f:
+                digest = sha1(f.read()).digest()
+        logos.append((logo_name, logo_abs_path, digest))
+    created = []
+    updated = []
+    unchanged = 0
+    not_owned = [] # Other kernelspecs with names from kernels dict
+    owned = load_owned(kernels_location, config["script"])
+    for kernel_name in registry.names:
+        if kernel_name not in installed:
+            created.append(kernel_name)
+            continue
+        if kernel_name not in owned:
+            not_owned.append(kernel_name)
+            continue
+        kernel_abs_path = join(kernels_location, kernel_name)
+        kernel_json_abs_path = join(kernel_abs_path, "kernel.json")
+        expected = kernel_json(registry[kernel_name]).encode("utf-8")
+        same = False
+        if isfile(kernel_json_abs_path):
+            with open(kernel_json_abs_path, 'rb') as f:
+                same = f.read() == expected
+        for logo_name, logo_abs_path, digest in logos:
+            same = same and same_file(join(kernel_abs_path, logo_name),
+                                      logo_abs_path, digest)
+        if same:
+            unchanged += 1
+        else:
+            updated.append(kernel_name)
+    # Remove kernels installed by rk, which are gone from kernels dict.
+    # Other kernelspecs and the template are left alone.
+    removed = [kernel_name for kernel_name in sorted(installed)
+               if kernel_name in owned and kernel_name not in registry and
+               kernel_name != config["kernel_name"]]
+    if not args.dry_run:
+        if created or updated:
+            install_kernels(created + updated, registry, kernels_location)
+        if removed:
             try:
-                rmtree(element_abs_path)
-            except Exception as exception: # Python3 PermissionError
-                error_code = exception.errno
-                if error_code == EACCES: # 13
-                    print(messages["_error_NoRoot"])
-                    exit(1)
-                else:
-                    print(messages["_error_Oops"] % strerror(error_code))
-                    exit(1)
-            kernel_names.append(element)
-    kernel_names.sort()
+                move_to_trash(kernels_location, [join(kernels_location, k)
+                                                 for k in removed])
+                update_owned(kernels_location, config["script"],
+                             removed=removed)
+            except (IOError, OSError) as exception:
+                exit_with_error(exception)
+            empty_trash_later(kernels_location)
+    for kernel_name in created:
+        print(messages["_synced_created"] % kernel_name)
+    for kernel_name in updated:
+        print(messages["_synced_updated"] % kernel_name)
+    for kernel_name in removed:
+        print(messages["_synced_removed"] % kernel_name)
+    if not_owned:
+        print(messages["_error_NotOwned"] % '\' \''.join(not_owned))
+    print(messages["_synced"] % (len(created), len(updated), len(removed),
+                                 unchanged))
+
+def uninstall_all(args):
+    """Uninstall all remote jupyter kernels installed by rk from kernels
+    location
+
+    """
+
+    from rk.kernelspecs import (empty_trash_later, load_owned, move_to_trash,
+                                update_owned)
+
+    kernels_location = config["kernels_location"]
+    if '~' in kernels_location:
+        kernels_location = expanduser(kernels_location)
+    # Only the kernels in the manifest, not other kernelspecs
+    owned = load_owned(kernels_location, config["script"])
+    kernel_names = sorted(kernel_name for kernel_name in owned
+                          if exists(join(kernels_location, kernel_name)))
+    if len(kernel_names) != 0:
+        try:
+            move_to_trash(kernels_location, [join(kernels_location, k)
+                                             for k in kernel_names])
+            update_owned(kernels_location, config["script"], removed=owned)
+        except (IOError, OSError) as exception:
+            exit_with_error(exception)
+        empty_trash_later(kernels_location)
     if len(kernel_names) == 0:
         print(messages["_uninstalled_all_zero"])
     elif len(kernel_names) == 1:
@@ -413,39 +935,17 @@ def uninstall_all(args):
 def uninstall_kernel(args):
     """Uninstall remote jupyter kernel/kernels"""
 
+    from rk.kernelspecs import (empty_trash_later, load_owned, move_to_trash,
+                                update_owned)
+
     kernels_location = config["kernels_location"]
     if '~' in kernels_location:
         kernels_location = expanduser(kernels_location)
     kernel_names = args.kernel_names
     if kernel_names == None:
         # Uninstall template of remote kernel
-        kernel_name = config["kernel_name"]
-        kernel_abs_path = join(kernels_location, kernel_name)
-        if exists(kernel_abs_path):
-            if isdir(kernel_abs_path):
-                try:
-                    rmtree(kernel_abs_path)
-                except Exception as exception: # Python3 PermissionError
-                    error_code = exception.errno
-                    if error_code == EACCES: # 13
-                        print(messages["_error_NoRoot"])
-                        exit(1)
-                    else:
-                        print(messages["_error_Oops"] % strerror(error_code))
-                        exit(1)
-            elif isfile(kernel_abs_path):
-                try:
-                    remove(kernel_abs_path)
-                except Exception as exception: # Python3 PermissionError
-                    error_code = exception.errno
-                    if error_code == EACCES: # 13
-                        print(messages["_error_NoRoot"])
-                        exit(1)
-                    else:
-                        print(messages["_error_Oops"] % strerror(error_code))
-                        exit(1)
-            print(messages["_uninstalled_template"])
-        else:
+        kernel_names = [config["kernel_name"]]
+        if not exists(join(kernels_location, kernel_names[0])):
             print(messages["_error_NoTemplate"])
             exit(1)
     else:
@@ -458,34 +958,29 @@ def uninstall_kernel(args):
                 no_kernel_names.append(kernel_name)
         if len(no_kernel_names) != 0:
             if len(no_kernel_names) == 1:
-                print(messages["_error_NoKernel"] % kernel_name)
+                print(messages["_error_NoKernel"] % no_kernel_names[0])
             else:
                 print(messages["_error_NoKernels"] %
                         '\' \''.join(no_kernel_names))
             exit(1)
+        # Only kernels installed by rk
+        owned = load_owned(kernels_location, config["script"])
+        not_owned = [k for k in kernel_names if k not in owned]
+        if len(not_owned) != 0:
+            print(messages["_error_NotOwned"] % '\' \''.join(not_owned))
+            exit(1)
         # /Check kernel_names list
+        kernel_names = sorted(set(kernel_names), key=kernel_names.index)
+    try:
+        move_to_trash(kernels_location, [join(kernels_location, k)
+                                         for k in kernel_names])
+        update_owned(kernels_location, config["script"],
+                     removed=kernel_names)
+    except (IOError, OSError) as exception:
+        exit_with_error(exception)
+    empty_trash_later(kernels_location)
+    if args.kernel_names == None:
+        print(messages["_uninstalled_template"])
+    else:
         for kernel_name in kernel_names:
-            kernel_abs_path = join(kernels_location, kernel_name)
-            if isdir(kernel_abs_path):
-                try:
-                    rmtree(kernel_abs_path)
-                except Exception as exception: # Python3 PermissionError
-                    error_code = exception.errno
-                    if error_code == EACCES: # 13
-                        print(messages["_error_NoRoot"])
-                        exit(1)
-                    else:
-                        print(messages["_error_Oops"] % strerror(error_code))
-                        exit(1)
-            elif isfile(kernel_abs_path):
-                try:
-                    remove(kernel_abs_path)
-                except Exception as exception: # Python3 PermissionError
-                    error_code = exception.errno
-                    if error_code == EACCES: # 13
-                        print(messages["_error_NoRoot"])
-                        exit(1)
-                    else:
-                        print(messages["_error_Oops"] % strerror(error_code))
-                        exit(1)
             print(messages["_uninstalled"] % kernel_name)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Registry of running remote kernel sessions
+
+Every rkscript writes a JSON record of its session to the sessions location
+and deletes it when the kernel exits. A record left behind by an rkscript
+that died (e.g. on SIGKILL) points to what leaked: the tunnel process and
+the kernel on the remote machine. Record keys:
+
+* ``session`` -- the local connection file name, without ".json",
+* ``connection_file``, ``remote_connection_file`` -- connection file paths,
+* ``remote_host`` -- the SSH server, with optional REMOTE_USERNAME@,
+* ``interpreter``, ``tunnel_backend``,
+* ``local_pid`` -- the rkscript (or any process using `rk.launcher`),
+  ``cmdline`` -- its command line, ``tunnel_pid`` -- the paramiko tunnel
+  process (None for OpenSSH tunnels, which exit when unused),
+  ``remote_pid`` -- the remote kernel,
+* ``port_pairs`` -- [local port, remote port] pairs,
+* ``started`` -- start time, in seconds since the epoch,
+* ``stats_file`` -- the Prometheus text file of the tunnel stats, or None.
+
+"""
+
+import errno
+import os
+import signal
+from json import dumps, load
+from os.path import basename, exists, join, splitext
+
+def session_id(connection_file):
+    """Session ID of a local connection file"""
+
+    return splitext(basename(connection_file))[0]
+
+def session_path(location, session):
+    return join(location, session + ".json")
+
+def write_session(location, record):
+    """Write a session record, in a location private to the user"""
+
+    from rk.files import replace_file
+
+    replace_file(session_path(location, record["session"]),
+                 dumps(record, indent=1, sort_keys=True), 0o700)
+
+def remove_session(location, session, stats_file=None):
+    """Delete a session record and its stats file, if they exist"""
+
+    for path in (session_path(location, session), stats_file):
+        if path == None:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def load_sessions(location):
+    """Return session records of the current user, oldest first"""
+
+    records = []
+    if not exists(location):
+        return records
+    for file_name in os.listdir(location):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(join(location, file_name), 'r') as f:
+                if os.fstat(f.fileno()).st_uid != os.getuid():
+                    continue
+                records.append(load(f))
+        except (IOError, OSError, ValueError):
+            continue
+    records.sort(key=lambda record: record.get("started", 0))
+    return records
+
+def is_alive(pid):
+    """Whether a local process exists"""
+
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as exception:
+        return exception.errno == errno.EPERM
+    return True
+
+def process_cmdline(pid):
+    """Command line of a local process, or None if unknown"""
+
+    try:
+        with open("/proc/%s/cmdline" % pid, 'rb') as f:
+            return f.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        return None
+
+def is_session_process(pid, record):
+    """Whether the rkscript or the tunnel of a session runs, and its pid is
+    not reused by another process. The tunnel is a fork of the rkscript, so
+    both have the command line of the record, or (in older records) one
+    with the connection file.
+
+    """
+
+    if not is_alive(pid):
+        return False
+    cmdline = process_cmdline(pid)
+    if cmdline == None:
+        return True # No /proc: trust the pid
+    if record.get("cmdline"):
+        return cmdline == record["cmdline"]
+    return record["connection_file"] in cmdline
+
+def is_running(record):
+    """Whether the rkscript of a session runs"""
+
+    return is_session_process(record.get("local_pid"), record)
+
+def kill_remote_kernel(record, timeout=None):
+    """Kill the remote kernel of a session, if its connection file is still
+    there (so the pid is not reused), and delete the connection file.
+    Return None or an error string.
+
+    """
+
+    from rk.ssh import tunnel
+
+    if not record.get("remote_pid") or not record.get(
+            "remote_connection_file"):
+        return None
+    username, server, port = tunnel._split_server(record["remote_host"])
+    client = tunnel._paramiko_client()
+    command = ("f='%s'; test -f \"$f\" && kill %i; rm -f \"$f\"; true" %
+               (record["remote_connection_file"].replace("'", ""),
+                int(record["remote_pid"])))
+    try:
+        client.connect(server, port, username=username, timeout=timeout,
+                       banner_timeout=timeout, auth_timeout=timeout)
+        stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+        stdout.channel.recv_exit_status()
+    except Exception as exception:
+        return str(exception) or exception.__class__.__name__
+    finally:
+        client.close()
+    return None
+
+def teardown(record, location, timeout=None):
+    """Stop the tunnel and the remote kernel of a dead session, and delete
+    its record. Return None or an error string.
+
+    """
+
+    tunnel_pid = record.get("tunnel_pid")
+    if is_session_process(tunnel_pid, record):
+        try:
+            os.kill(tunnel_pid, signal.SIGTERM)
+        except OSError:
+            pass
+    error = kill_remote_kernel(record, timeout)
+    if error == None:
+        remove_session(location, record["session"], record.get("stats_file"))
+    return error
+
+def teardown_sessions(records, location, workers=32, timeout=None):
+    """Tear down sessions in parallel, return {session: None or error}"""
+
+    from rk.ssh import tunnel
+
+    errors = tunnel.map_hosts(lambda record: teardown(record, location,
+                                                      timeout),
+                              records, workers)
+    return dict((record["session"], error)
+                for record, error in zip(records, errors))
@@ -18,74 +18,451 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA  02111-1301  USA.
 
 """
-Sample script showing how to do local port forwarding over paramiko.
+Local port forwarding over paramiko.
 
-This script connects to the requested SSH server and sets up local port
-forwarding (the openssh -L option) from a local port through a tunneled
-connection to a destination reachable from the SSH server machine.
+Sets up local port forwarding (the openssh -L option) from local ports
+through tunneled connections to destinations reachable from the SSH server
+machine. All listeners and channels are served by a single thread from one
+selector loop, instead of one thread per accepted connection.
+
+The listeners outlive the transport: once it dies, its connections are
+closed and `Forwarder.serve_forever` returns, and new connections wait in
+the listen backlog until a new transport is set and served.
+
+Channels are opened by short-lived threads, so a slow server delays only
+the new connection, never the relaying of the open ones; the loop picks
+each channel up once it is open.
+
+Every forwarded port counts its traffic, connections and channel open
+times in a `rk.ssh.stats.PortStats`, and a `Forwarder` given a stats path
+writes them there every few seconds.
 """
 
 from __future__ import print_function
 
+import errno
 import logging
-import select
-try:  # Python 3
-    import socketserver
+import socket
+import threading
+import time
+from collections import deque
+from functools import partial
+try:  # Python 3.4+
+    import selectors
 except ImportError:  # Python 2
-    import SocketServer as socketserver
+    import selectors34 as selectors
+
+from .ports import listen
+from .stats import PortStats, write_stats
 
 logger = logging.getLogger('ssh')
 
-class ForwardServer (socketserver.ThreadingTCPServer):
-    daemon_threads = True
-    allow_reuse_address = True
-    
+CHUNK_SIZE = 65536 # Bytes read per recv() call
+MAX_BUFFER = 262144 # Bytes buffered per direction before reading pauses
+POLL_INTERVAL = 0.005 # Seconds between retries of sends to full channels
+CHECK_INTERVAL = 1.0 # Seconds between checks of the transport
+STATS_INTERVAL = 5.0 # Seconds between writes of the stats file
+OPEN_TIMEOUT = 10.0 # Seconds to wait for the server to open a channel
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Buffer (object):
+    """Preallocated byte buffer holding the pending bytes in [start:end).
+
+    Data is read into and written out of memoryview slices of one
+    bytearray, so the buffer itself allocates nothing per chunk.
+    """
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def space(self):
+        return len(self.data) - len(self)
+
+    def writable(self, size):
+        """Return a view of up to `size` free bytes after the pending ones."""
+        if self.end + size > len(self.data) and self.start:
+            # Move the pending bytes to the front (memmove, no allocation)
+            pending = len(self)
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:min(self.end + size, len(self.data))]
+
+    def produce(self, size):
+        self.end += size
+
+    def readable(self):
+        return self.view[self.start:self.end]
+
+    def consume(self, size):
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+class Handler (object):
+    """Relay between one accepted local connection and its ssh channel.
 
-class Handler (socketserver.BaseRequestHandler):
+    Each direction owns one `Buffer` of `max_buffer` bytes. Local sockets
+    are read straight into their buffer; channel reads return new bytes
+    objects, which paramiko offers no way around. Partial writes
+    leave the rest of the data buffered until the peer accepts it, and a
+    full buffer stops reads from that side, so a slow reader throttles the
+    sender (over ssh, through the channel window) instead of losing bytes
+    or growing memory.
+    """
 
-    def handle(self):
+    def __init__(self, forwarder, request, chan, chunk_size=CHUNK_SIZE,
+                 max_buffer=MAX_BUFFER, stats=None):
+        self.forwarder = forwarder
+        self.stats = stats if stats is not None else PortStats(None, None, None)
+        self.stats.active += 1
+        self.request = request
+        self.chan = chan
+        self.chunk_size = chunk_size
+        self.upstream = Buffer(max(max_buffer, chunk_size)) # request -> chan
+        self.downstream = Buffer(max(max_buffer, chunk_size)) # chan -> request
+        self.request_eof = False
+        self.chan_eof = False
+        self.closed = False
+        forwarder.handlers.add(self)
+        request.setblocking(False)
+        chan.settimeout(0.0)
+
+    def on_request_event(self, events):
         try:
-            chan = self.ssh_transport.open_channel('direct-tcpip',
-                                                   (self.chain_host, self.chain_port),
-                                                   self.request.getpeername())
-        except Exception as e:
-            logger.debug('Incoming request to %s:%d failed: %s' % (self.chain_host,
-                                                              self.chain_port,
-                                                              repr(e)))
+            if events & selectors.EVENT_WRITE:
+                self.write_request()
+            if events & selectors.EVENT_READ:
+                self.read_request()
+        except socket.error as e:
+            logger.debug('Tunnel error: %r' % e)
+            self.close()
+            return
+        self.update()
+
+    def on_chan_event(self, events):
+        try:
+            self.read_chan()
+        except socket.error as e:
+            logger.debug('Tunnel error: %r' % e)
+            self.close()
+            return
+        self.update()
+
+    def on_chan_writable(self):
+        try:
+            self.write_chan()
+        except socket.error as e:
+            logger.debug('Tunnel error: %r' % e)
+            self.close()
+            return
+        self.update()
+
+    def read_request(self):
+        try:
+            size = self.request.recv_into(
+                self.upstream.writable(self.chunk_size))
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK:
+                return
+            raise
+        if size == 0:
+            self.request_eof = True
+            return
+        self.upstream.produce(size)
+        self.stats.sent_bytes += size
+        self.write_chan()
+
+    def write_chan(self):
+        while len(self.upstream):
+            try:
+                size = self.chan.send(self.upstream.readable())
+            except socket.timeout: # Channel window is full
+                return
+            if size == 0: # Channel closed
+                self.chan_eof = True
+                self.upstream.consume(len(self.upstream))
+                return
+            self.upstream.consume(size)
+
+    def read_chan(self):
+        # paramiko channels have no recv_into, so every chunk from the
+        # channel is a new bytes object; it is sent as is when possible,
+        # and only the unsent rest is copied into the buffer
+        try:
+            data = self.chan.recv(min(self.chunk_size,
+                                      self.downstream.space()))
+        except socket.timeout:
             return
-        if chan is None:
-            logger.debug('Incoming request to %s:%d was rejected by the SSH server.' %
-                    (self.chain_host, self.chain_port))
+        if len(data) == 0:
+            self.chan_eof = True
             return
+        self.stats.received_bytes += len(data)
+        sent = 0
+        if not len(self.downstream):
+            # Nothing is queued, so try to hand the data straight over
+            try:
+                sent = self.request.send(data)
+            except socket.error as e:
+                if e.errno not in _WOULD_BLOCK:
+                    raise
+            if sent == len(data):
+                return
+        size = len(data) - sent
+        self.downstream.writable(size)[:] = memoryview(data)[sent:]
+        self.downstream.produce(size)
 
-        logger.debug('Connected!  Tunnel open %r -> %r -> %r' % (self.request.getpeername(),
-                                                            chan.getpeername(), (self.chain_host, self.chain_port)))
-        while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
-        chan.close()
+    def write_request(self):
+        while len(self.downstream):
+            try:
+                size = self.request.send(self.downstream.readable())
+            except socket.error as e:
+                if e.errno in _WOULD_BLOCK:
+                    return
+                raise
+            self.downstream.consume(size)
+
+    def update(self):
+        """Close once a finished side is flushed, else re-arm the events."""
+        if self.closed:
+            return
+        if ((self.request_eof and not len(self.upstream)) or
+                (self.chan_eof and not len(self.downstream))):
+            self.close()
+            return
+        request_events = 0
+        if not self.request_eof and self.upstream.space():
+            request_events |= selectors.EVENT_READ
+        if len(self.downstream):
+            request_events |= selectors.EVENT_WRITE
+        chan_events = 0
+        if not self.chan_eof and self.downstream.space():
+            chan_events |= selectors.EVENT_READ
+        self.forwarder.watch(self.request, request_events,
+                             self.on_request_event)
+        self.forwarder.watch(self.chan, chan_events, self.on_chan_event)
+        self.forwarder.set_pending(self, bool(len(self.upstream)))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.forwarder.watch(self.request, 0)
+        self.forwarder.watch(self.chan, 0)
+        self.forwarder.set_pending(self, False)
+        self.forwarder.handlers.discard(self)
+        self.stats.active -= 1
+        self.chan.close()
         self.request.close()
         logger.debug('Tunnel closed ')
 
 
+class Forwarder (object):
+    """Serve any number of forwarded ports over one transport in one loop.
+
+    `ssh_transport` may be replaced between calls of `serve_forever`, e.g.
+    by a reconnected one: the listeners, and so the local ports, stay.
+
+    With `stats_path`, the stats of all ports, labelled with `stats_labels`,
+    are written there every `stats_interval` seconds while serving.
+    """
+
+    def __init__(self, transport=None, chunk_size=CHUNK_SIZE,
+                 max_buffer=MAX_BUFFER, stats_path=None,
+                 stats_interval=STATS_INTERVAL, stats_labels=None,
+                 open_timeout=OPEN_TIMEOUT):
+        self.ssh_transport = transport
+        self.chunk_size = chunk_size
+        self.max_buffer = max_buffer
+        self.stats_path = stats_path
+        self.stats_interval = stats_interval
+        self.stats_labels = stats_labels
+        self.open_timeout = open_timeout
+        self.port_stats = []
+        self.selector = selectors.DefaultSelector()
+        self.listeners = []
+        self.pending = set() # Handlers waiting for channel window
+        self.handlers = set() # Open connections
+        # Connections with open channels, from the opening threads, which
+        # wake the loop up through the socket pair
+        self.opened = deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.watch(self.wakeup_recv, selectors.EVENT_READ, self.on_opened)
+
+    def add_listener(self, local_port, chain_host, chain_port, name=None):
+        """Listen on 127.0.0.1:local_port and tunnel every accepted
+        connection to chain_host:chain_port as seen from the ssh server.
+
+        local_port may also be a listening socket, e.g. from
+        `rk.ssh.ports.allocate`: it is used as is, so the port is never
+        free in between. name labels the stats of the port, e.g. "iopub";
+        it defaults to the local port number.
+        """
+        if isinstance(local_port, socket.socket):
+            listener = local_port
+        else:
+            listener = listen(local_port)
+        listener.setblocking(False)
+        port = listener.getsockname()[1]
+        stats = PortStats(name or str(port), port, chain_port)
+        self.listeners.append(listener)
+        self.port_stats.append(stats)
+        self.watch(listener, selectors.EVENT_READ,
+                   partial(self.accept, listener, chain_host, chain_port,
+                           stats))
+        return listener
+
+    def accept(self, listener, chain_host, chain_port, stats, events):
+        try:
+            request, peer = listener.accept()
+        except socket.error:
+            return
+        stats.connections += 1
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        t = threading.Thread(target=self.open_channel,
+                             args=(self.ssh_transport, request, peer,
+                                   chain_host, chain_port, stats))
+        t.daemon = True
+        t.start()
+
+    def open_channel(self, transport, request, peer, chain_host, chain_port,
+                     stats):
+        """Open the channel of an accepted connection, in its own thread,
+        and hand it to the loop.
+        """
+        start = time.time()
+        try:
+            chan = transport.open_channel('direct-tcpip',
+                                          (chain_host, chain_port), peer,
+                                          timeout=self.open_timeout)
+        except Exception as e:
+            logger.debug('Incoming request to %s:%d failed: %s' % (chain_host,
+                                                              chain_port,
+                                                              repr(e)))
+            chan = None
+        else:
+            if chan is None:
+                logger.debug('Incoming request to %s:%d was rejected by the SSH server.' %
+                        (chain_host, chain_port))
+        self.opened.append((request, peer, chan, chain_host, chain_port,
+                            stats, time.time() - start))
+        try:
+            self.wakeup_send.send(b'x')
+        except socket.error:
+            pass # Already woken up, or closed
+
+    def on_opened(self, events):
+        """Start relaying the connections whose channels are open."""
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self.opened:
+            (request, peer, chan, chain_host, chain_port, stats,
+             elapsed) = self.opened.popleft()
+            if chan is None:
+                stats.open_failures += 1
+                request.close()
+                continue
+            stats.opened(elapsed)
+            logger.debug('Connected!  Tunnel open %r -> %r -> %r' % (peer,
+                                                                chan.getpeername(), (chain_host, chain_port)))
+            Handler(self, request, chan, self.chunk_size, self.max_buffer,
+                    stats).update()
+
+    def watch(self, fileobj, events, callback=None):
+        """Register, modify or (with no events) unregister `fileobj`."""
+        try:
+            key = self.selector.get_key(fileobj)
+        except (KeyError, ValueError):
+            key = None
+        if not events:
+            if key is not None:
+                self.selector.unregister(fileobj)
+        elif key is None:
+            self.selector.register(fileobj, events, callback)
+        elif key.events != events or key.data != callback:
+            self.selector.modify(fileobj, events, callback)
+
+    def set_pending(self, handler, pending):
+        if pending:
+            self.pending.add(handler)
+        else:
+            self.pending.discard(handler)
+
+    def serve_forever(self):
+        """Serve until the transport dies, then close its connections."""
+        transport = self.ssh_transport
+        next_stats = time.time()
+        while transport.is_active():
+            timeout = POLL_INTERVAL if self.pending else CHECK_INTERVAL
+            if self.stats_path:
+                now = time.time()
+                if now >= next_stats:
+                    self.write_stats()
+                    next_stats = now + self.stats_interval
+                timeout = min(timeout, next_stats - now)
+            for key, events in self.selector.select(timeout):
+                key.data(events)
+            for handler in list(self.pending):
+                handler.on_chan_writable()
+        for handler in list(self.handlers):
+            handler.close()
+        if self.stats_path:
+            self.write_stats()
+
+    def write_stats(self):
+        """Write the stats file; failures are only logged"""
+        try:
+            write_stats(self.stats_path, self.port_stats, self.stats_labels)
+        except (IOError, OSError) as e:
+            logger.debug('Writing stats to %s failed: %r' % (self.stats_path,
+                                                             e))
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+        self.selector.close()
+        self.wakeup_send.close()
+        while self.opened:
+            request, peer, chan = self.opened.popleft()[:3]
+            if chan is not None:
+                chan.close()
+            request.close()
+
+
 def forward_tunnel(local_port, remote_host, remote_port, transport):
-    # this is a little convoluted, but lets me configure things for the Handler
-    # object.  (SocketServer doesn't give Handlers any way to access the outer
-    # server normally.)
-    class SubHander (Handler):
-        chain_host = remote_host
-        chain_port = remote_port
-        ssh_transport = transport
-    ForwardServer(('127.0.0.1', local_port), SubHander).serve_forever()
+    forward_tunnels([(local_port, remote_port)], remote_host, transport)
+
+
+def forward_tunnels(port_pairs, remote_host, transport, chunk_size=CHUNK_SIZE,
+                    max_buffer=MAX_BUFFER):
+    """Forward every (local_port, remote_port) pair over one transport.
+    local_port may be a listening socket, see `Forwarder.add_listener`.
+
+    All local ports are served by one `Forwarder`, and every connection
+    opens its own 'direct-tcpip' channel on the same `transport`, so a
+    single SSH connection and a single thread carry every forwarded port.
+    """
+    forwarder = Forwarder(transport, chunk_size, max_buffer)
+    for local_port, remote_port in port_pairs:
+        forwarder.add_listener(local_port, remote_host, remote_port)
+    try:
+        forwarder.serve_forever()
+    finally:
+        forwarder.close()
 
 
-__all__ = ['forward_tunnel']
+__all__ = ['forward_tunnel', 'forward_tunnels', 'Forwarder']
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Race-free selection of free TCP ports
+
+Binding to port 0 and closing the socket gives a free port, but it is free
+for every other process too until somebody binds it again, and kernels
+started at the same time may get the same port. Here ports are returned as
+sockets that stay bound (and listening) until the caller hands them over,
+e.g. to `rk.ssh.forward.Forwarder.add_listener`, and every chosen port is
+leased in a locked lease file, shared by all processes of the user, for
+long enough that the kernel binds it. Leases are never ended early, they
+only expire, after `lease_ttl` seconds. Ports can be limited to a range.
+
+This module only uses the standard library: its source is also sent to
+remote machines by the rkscript.
+"""
+
+import errno
+import json
+import os
+import random
+import socket
+import time
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+lease_location = "~/.rk/ports" # Private to the user, like the agent
+lease_ttl = 60 # Seconds, long enough for a kernel to bind its ports
+
+
+def parse_port_range(value):
+    """Return (first, last) ports from "first-last", or None for ""."""
+    if not value:
+        return None
+    first, last = [int(port) for port in value.split('-')]
+    if not 0 < first <= last <= 65535:
+        raise ValueError("invalid port range: %s" % value)
+    return first, last
+
+def listen(port=0, host='127.0.0.1'):
+    """Return a listening socket bound to host:port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+class _Leases(object):
+    """The lease file, locked for the lifetime of a with statement.
+
+    The lease file is shared by the processes of the user, so it is
+    written in place, under the lock, and not replaced.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.leases = {} # Port: expiry time
+
+    def __enter__(self):
+        location = os.path.expanduser(self.location)
+        if not os.path.exists(location):
+            try:
+                os.makedirs(location, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = os.path.join(location, "leases.json")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.file = os.fdopen(fd, 'r+')
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        now = time.time()
+        try:
+            leases = json.loads(self.file.read() or "{}")
+        except ValueError:
+            leases = {}
+        self.leases = dict((int(port), expiry)
+                           for port, expiry in leases.items() if expiry > now)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(json.dumps(dict((str(port), expiry)
+                    for port, expiry in self.leases.items())))
+            self.file.flush()
+        finally:
+            self.file.close() # Unlocks
+
+def allocate(n, port_range=None, host='127.0.0.1', location=lease_location,
+             ttl=lease_ttl):
+    """Return n listening sockets on free, leased ports.
+
+    Ports leased by other processes during the last ttl seconds are skipped.
+    The new leases expire after ttl seconds.
+    port_range is a (first, last) pair; by default the system picks from its
+    ephemeral ports.
+    """
+    socks = []
+    with _Leases(location) as leases:
+        try:
+            if port_range is None:
+                attempts = 0
+                while len(socks) < n:
+                    sock = listen(0, host)
+                    if sock.getsockname()[1] in leases.leases:
+                        sock.close()
+                        attempts += 1
+                        if attempts > 100:
+                            raise RuntimeError("no free ports")
+                        continue
+                    socks.append(sock)
+                    leases.leases[sock.getsockname()[1]] = time.time() + ttl
+            else:
+                first, last = port_range
+                ports = list(range(first, last + 1))
+                # Concurrent callers start at different ports
+                start = random.randrange(len(ports))
+                for port in ports[start:] + ports[:start]:
+                    if len(socks) == n:
+                        break
+                    if port in leases.leases:
+                        continue
+                    try:
+                        sock = listen(port, host)
+                    except socket.error:
+                        continue # In use
+                    socks.append(sock)
+                    leases.leases[port] = time.time() + ttl
+                if len(socks) < n:
+                    raise RuntimeError("no free ports in %i-%i" % port_range)
+        except Exception:
+            for sock in socks:
+                leases.leases.pop(sock.getsockname()[1], None)
+                sock.close()
+            raise
+    return socks
+
+
+__all__ = ['allocate', 'listen', 'parse_port_range']
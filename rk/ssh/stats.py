@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Traffic and latency counters of forwarded ports
+
+A `rk.ssh.forward.Forwarder` keeps one `PortStats` per forwarded port and
+can write them all, every few seconds, to a file in the Prometheus text
+format, e.g. for the textfile collector of the node exporter::
+
+    rk_forward_sent_bytes_total{port="iopub",...} 1024
+    rk_forward_channel_open_seconds_bucket{port="iopub",le="0.01",...} 3
+
+Sent bytes go from the local port to the remote host, received bytes come
+back from it.
+"""
+
+# Upper bounds (seconds) of the channel open latency histogram buckets
+OPEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                2.5, 5.0, 10.0)
+
+_METRICS = (
+    # Name, type, help, PortStats attribute
+    ("rk_forward_sent_bytes_total", "counter",
+     "Bytes sent from the local port to the remote host.", "sent_bytes"),
+    ("rk_forward_received_bytes_total", "counter",
+     "Bytes received from the remote host for the local port.",
+     "received_bytes"),
+    ("rk_forward_connections_total", "counter",
+     "Accepted local connections.", "connections"),
+    ("rk_forward_open_failures_total", "counter",
+     "Local connections whose channel did not open.", "open_failures"),
+    ("rk_forward_active_channels", "gauge",
+     "Open channels.", "active"),
+)
+
+class PortStats(object):
+    """Counters of one forwarded port"""
+
+    def __init__(self, name, local_port, remote_port):
+        self.name = name
+        self.local_port = local_port
+        self.remote_port = remote_port
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.connections = 0
+        self.open_failures = 0
+        self.active = 0
+        self.open_buckets = [0] * len(OPEN_BUCKETS)
+        self.open_sum = 0.0
+        self.open_count = 0
+
+    def opened(self, seconds):
+        """Count a channel opened in `seconds`"""
+        self.open_sum += seconds
+        self.open_count += 1
+        for i, bound in enumerate(OPEN_BUCKETS):
+            if seconds <= bound:
+                self.open_buckets[i] += 1
+                break
+
+    def labels(self, extra=None):
+        labels = dict(extra or {})
+        labels.update(port=self.name, local_port=self.local_port,
+                      remote_port=self.remote_port)
+        return labels
+
+def _format_labels(labels):
+    return ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+def prometheus_text(port_stats, labels=None):
+    """Return the stats of ports in the Prometheus text format"""
+
+    lines = []
+    for name, kind, text, attribute in _METRICS:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for stats in port_stats:
+            lines.append("%s{%s} %s" % (name,
+                         _format_labels(stats.labels(labels)),
+                         getattr(stats, attribute)))
+    name = "rk_forward_channel_open_seconds"
+    lines.append("# HELP %s Time to open a channel for a local connection."
+                 % name)
+    lines.append("# TYPE %s histogram" % name)
+    for stats in port_stats:
+        cumulative = 0
+        for bound, count in zip(OPEN_BUCKETS, stats.open_buckets):
+            cumulative += count
+            lines.append("%s_bucket{%s} %i" % (name, _format_labels(
+                         dict(stats.labels(labels), le=repr(bound))),
+                         cumulative))
+        lines.append("%s_bucket{%s} %i" % (name, _format_labels(
+                     dict(stats.labels(labels), le="+Inf")),
+                     stats.open_count))
+        lines.append("%s_sum{%s} %r" % (name,
+                     _format_labels(stats.labels(labels)), stats.open_sum))
+        lines.append("%s_count{%s} %i" % (name,
+                     _format_labels(stats.labels(labels)), stats.open_count))
+    return "\n".join(lines) + "\n"
+
+def write_stats(path, port_stats, labels=None):
+    """Replace the stats file at path, in a location private to the user"""
+
+    from rk.files import replace_file
+
+    replace_file(path, prometheus_text(port_stats, labels), 0o700)
+
+
+__all__ = ['PortStats', 'prometheus_text', 'write_stats']
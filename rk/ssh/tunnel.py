@@ -11,13 +11,23 @@ zeromq connections.
 from __future__ import print_function
 
 import atexit
+import logging
 import os
 import signal
 import socket
 import sys
+import tempfile
+import threading
+import time
 import warnings
 from getpass import getpass, getuser
 from multiprocessing import Process
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+from .ports import allocate
 
 try:
     with warnings.catch_warnings():
@@ -29,7 +39,7 @@ except ImportError:
     class SSHException(Exception):
         pass
 else:
-    from .forward import forward_tunnel
+    from .forward import Forwarder
 
 try:
     import pexpect
@@ -39,51 +49,144 @@ except ImportError:
 
 _random_ports = set()
 
+# Process-wide caches, shared by all tunnels (and inherited by forked tunnel
+# processes): passwordless login results per (server, keyfile), and the
+# parsed system known_hosts files.
+PASSWORDLESS_TTL = 300 # Seconds
+_passwordless = {} # (server, keyfile, paramiko): (result, time of the check)
+_system_host_keys = None
+_system_host_keys_lock = threading.Lock()
+
+# Paramiko tunnels send a keepalive request every KEEPALIVE_INTERVAL seconds
+# and reconnect when KEEPALIVE_COUNT_MAX of them get no reply (like
+# OpenSSH's ServerAliveInterval and ServerAliveCountMax), waiting
+# RECONNECT_DELAY seconds after a failed reconnect, twice as long after the
+# next one, and so on up to RECONNECT_DELAY_MAX.
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT_MAX = 3
+RECONNECT_DELAY = 0.5
+RECONNECT_DELAY_MAX = 30
+
 def select_random_ports(n):
-    """Selects and return n random ports that are available."""
+    """Selects and return n random ports that are available.
+
+    The ports are leased for other processes using `rk.ssh.ports` too, but
+    they are free until bound again: prefer `rk.ssh.ports.allocate`, which
+    returns the bound sockets.
+    """
     ports = []
-    for i in range(n):
-        sock = socket.socket()
-        sock.bind(('', 0))
-        while sock.getsockname()[1] in _random_ports:
-            sock.close()
-            sock = socket.socket()
-            sock.bind(('', 0))
-        ports.append(sock)
-    for i, sock in enumerate(ports):
+    for sock in allocate(n):
         port = sock.getsockname()[1]
         sock.close()
-        ports[i] = port
+        ports.append(port)
         _random_ports.add(port)
     return ports
 
 
+#-----------------------------------------------------------------------------
+# Shared paramiko client setup
+#-----------------------------------------------------------------------------
+
+def system_host_keys():
+    """Return the system known_hosts as a paramiko.HostKeys, parsed only
+    once per process.
+
+    Loads the same files as `paramiko.SSHClient.load_system_host_keys`.
+    """
+    global _system_host_keys
+    with _system_host_keys_lock:
+        if _system_host_keys is None:
+            host_keys = paramiko.HostKeys()
+            for path in ('~/.ssh/known_hosts', '~/ssh/known_hosts'):
+                try:
+                    host_keys.load(os.path.expanduser(path))
+                except IOError:
+                    pass
+                else:
+                    break
+            _system_host_keys = host_keys
+    return _system_host_keys
+
+def _paramiko_client():
+    """Return a paramiko.SSHClient using the shared system host keys."""
+    client = paramiko.SSHClient()
+    # Instead of client.load_system_host_keys(), which parses known_hosts
+    # again for every client
+    client._system_host_keys = system_host_keys()
+    #client.set_missing_host_key_policy(paramiko.WarningPolicy())
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return client
+
+def map_hosts(function, items, workers=32):
+    """Return [function(item) for item in items], called in parallel from
+    a bounded thread pool, e.g. one call per remote host.
+
+    function reports its own failures, e.g. in its result, so paramiko
+    tracebacks are kept off the terminal.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    items = list(items)
+    if not items:
+        return []
+    logging.getLogger("paramiko").addHandler(logging.NullHandler())
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 #-----------------------------------------------------------------------------
 # Check for passwordless login
 #-----------------------------------------------------------------------------
 
-def try_passwordless_ssh(server, keyfile, paramiko=None):
+def try_passwordless_ssh(server, keyfile, paramiko=None, timeout=None,
+                         cache=True):
     """Attempt to make an ssh connection without a password.
     This is mainly used for requiring password input only once
     when many tunnels may be connected to the same server.
     
     If paramiko is None, the default for the platform is chosen.
+    If timeout (in seconds) is given, an unreachable server raises an
+    error after timeout instead of waiting for the system TCP timeout.
+    If cache is True, a result from the last PASSWORDLESS_TTL seconds
+    for the same server, keyfile and backend is returned without
+    connecting.
     """
     if paramiko is None:
         paramiko = sys.platform == 'win32'
+    key = (server, keyfile, bool(paramiko))
+    if cache and key in _passwordless:
+        result, checked = _passwordless[key]
+        if time.time() - checked < PASSWORDLESS_TTL:
+            return result
     if not paramiko:
         f = _try_passwordless_openssh
     else:
         f = _try_passwordless_paramiko
-    return f(server, keyfile)
+    result = f(server, keyfile, timeout)
+    _passwordless[key] = (result, time.time())
+    return result
+
+def remember_passwordless(server, keyfile, result, paramiko=None):
+    """Record a passwordless login result found elsewhere, e.g. in a cache
+    of an earlier process, for `try_passwordless_ssh` with the same
+    backend.
+    """
+    if paramiko is None:
+        paramiko = sys.platform == 'win32'
+    _passwordless[(server, keyfile, bool(paramiko))] = (result, time.time())
 
-def _try_passwordless_openssh(server, keyfile):
+def _try_passwordless_openssh(server, keyfile, timeout=None):
     """Try passwordless login with shell ssh command."""
     if pexpect is None:
         raise ImportError("pexpect unavailable, use paramiko")
     cmd = 'ssh -f '+ server
     if keyfile:
         cmd += ' -i ' + keyfile
+    if timeout:
+        cmd += ' -o ConnectTimeout=%i' % max(1, timeout)
     cmd += ' exit'
     
     # pop SSH_ASKPASS from env
@@ -92,19 +195,12 @@ def _try_passwordless_openssh(server, keyfile):
 
     ssh_newkey = 'Are you sure you want to continue connecting'
     p = pexpect.spawn(cmd, env=env)
-    while True:
-        try:
-            i = p.expect([ssh_newkey, '[Pp]assword:'], timeout=.1)
-            if i==0:
-                raise SSHException('The authenticity of the host can\'t be established.')
-        except pexpect.TIMEOUT:
-            continue
-        except pexpect.EOF:
-            return True
-        else:
-            return False
+    i = p.expect([ssh_newkey, '[Pp]assword:', pexpect.EOF], timeout=None)
+    if i==0:
+        raise SSHException('The authenticity of the host can\'t be established.')
+    return i==2
 
-def _try_passwordless_paramiko(server, keyfile):
+def _try_passwordless_paramiko(server, keyfile, timeout=None):
     """Try passwordless login with paramiko."""
     if paramiko is None:
         msg = "Paramiko unavaliable, "
@@ -114,13 +210,11 @@ def _try_passwordless_paramiko(server, keyfile):
             msg += "use OpenSSH."
         raise ImportError(msg)
     username, server, port = _split_server(server)
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    #client.set_missing_host_key_policy(paramiko.WarningPolicy())
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client = _paramiko_client()
     try:
         client.connect(server, port, username=username, key_filename=keyfile,
-               look_for_keys=True)
+               look_for_keys=True, timeout=timeout, banner_timeout=timeout,
+               auth_timeout=timeout)
     except paramiko.AuthenticationException:
         return False
     else:
@@ -204,6 +298,51 @@ def openssh_tunnel(lport, rport, server, remoteip='127.0.0.1', keyfile=None, pas
         The time (in seconds) after which no activity will result in the tunnel
         closing.  This prevents orphaned tunnels from running forever.
     """
+    return openssh_multi_tunnel([(lport, rport)], server, remoteip=remoteip,
+                                keyfile=keyfile, password=password,
+                                timeout=timeout)
+
+def openssh_multi_tunnel(port_pairs, server, remoteip='127.0.0.1', keyfile=None, password=None, timeout=60,
+                         ciphers=None, macs=None, compression=None):
+    """Create an ssh tunnel for several ports at once using command-line ssh.
+    
+    This is `openssh_tunnel` for several ports: all of them are forwarded
+    by one `ssh -f` process, or by one `ssh -O forward` request to an
+    already running ControlMaster for `server`.
+    
+    If you are familiar with ssh tunnels, this creates the tunnel:
+    
+    ssh server -L localhost:lport1:remoteip:rport1 -L localhost:lport2:remoteip:rport2 ...
+    
+    Parameters
+    ----------
+    
+    port_pairs : list of (int, int)
+        (lport, rport) pairs: the local port for connecting to the tunnel
+        from this machine and the port on the remote machine to connect to.
+        lport may also be a listening socket on 127.0.0.1, e.g. from
+        `rk.ssh.ports.allocate`; it is closed in this process.
+    server : str
+        The ssh server to connect to. The full ssh server string will be parsed.
+        user@server:port
+    remoteip : str [Default: 127.0.0.1]
+        The remote ip, specifying the destination of every tunneled port.
+    keyfile : str; path to public key file
+        This specifies a key to be used in ssh login, default None.
+        Regular default ssh keys will be used without specifying this argument.
+    password : str; 
+        Your ssh password to the ssh server. Note that if this is left None,
+        you will be prompted for it if passwordless key based login is unavailable.
+    timeout : int [default: 60]
+        The time (in seconds) after which no activity will result in the tunnel
+        closing.  This prevents orphaned tunnels from running forever.
+    ciphers, macs : list of str
+        The ciphers and MACs to use, most preferred first (ssh -c and -m).
+        A running ControlMaster is not used with them, as its connection
+        is already negotiated.
+    compression : bool
+        Whether to compress the connection (ssh -o Compression).
+    """
     if pexpect is None:
         raise ImportError("pexpect unavailable, use paramiko_tunnel")
     ssh="ssh "
@@ -213,39 +352,66 @@ def openssh_tunnel(lport, rport, server, remoteip='127.0.0.1', keyfile=None, pas
     if ':' in server:
         server, port = server.split(':')
         ssh += " -p %s" % port
+    if ciphers:
+        ssh += " -c %s" % ",".join(ciphers)
+    if macs:
+        ssh += " -m %s" % ",".join(macs)
+    if compression is not None:
+        ssh += " -o Compression=%s" % ("yes" if compression else "no")
     
+    # ssh binds the local ports itself: free the ones given as sockets
+    port_pairs = [(_release_socket(lport), rport)
+                  for lport, rport in port_pairs]
+    forwards = " ".join("-L 127.0.0.1:%i:%s:%i" % (lport, remoteip, rport)
+                        for lport, rport in port_pairs)
     cmd = "%s -O check %s" % (ssh, server)
-    (output, exitstatus) = pexpect.run(cmd, withexitstatus=True)
+    if ciphers or macs or compression is not None:
+        exitstatus = 1 # Needs its own connection
+    else:
+        (output, exitstatus) = pexpect.run(cmd, withexitstatus=True)
     if not exitstatus:
+        if not isinstance(output, str):
+            output = output.decode('utf-8', 'replace')
         pid = int(output[output.find("(pid=")+5:output.find(")")]) 
-        cmd = "%s -O forward -L 127.0.0.1:%i:%s:%i %s" % (
-            ssh, lport, remoteip, rport, server)
+        cmd = "%s -O forward %s %s" % (ssh, forwards, server)
         (output, exitstatus) = pexpect.run(cmd, withexitstatus=True)
         if not exitstatus:
             atexit.register(_stop_tunnel, cmd.replace("-O forward", "-O cancel", 1))
             return pid
-    cmd = "%s -f -S none -L 127.0.0.1:%i:%s:%i %s sleep %i" % (
-        ssh, lport, remoteip, rport, server, timeout)
+    cmd = "%s -f -S none -o ExitOnForwardFailure=yes %s %s sleep %i" % (
+        ssh, forwards, server, timeout)
     
     # pop SSH_ASKPASS from env
     env = os.environ.copy()
     env.pop('SSH_ASKPASS', None)
     
     ssh_newkey = 'Are you sure you want to continue connecting'
-    tunnel = pexpect.spawn(cmd, env=env)
+    # The ssh in the background keeps copies of its stdout and stderr for
+    # the "sleep" session: redirect them, so that the pty is closed (EOF) as
+    # soon as ssh forks. Prompts still use the pty, as /dev/tty.
+    fd, errors = tempfile.mkstemp(prefix='rk-ssh-')
+    os.close(fd)
+    # ignore_sighup: the ssh that forks into the background must survive
+    # its parent, the session leader of the pty, exiting
+    tunnel = pexpect.spawn('/bin/sh', ['-c', 'exec %s >/dev/null 2>%s' % (
+        cmd, errors)], env=env, ignore_sighup=True)
     failed = False
     while True:
-        try:
-            i = tunnel.expect([ssh_newkey, '[Pp]assword:'], timeout=.1)
-            if i==0:
-                raise SSHException('The authenticity of the host can\'t be established.')
-        except pexpect.TIMEOUT:
-            continue
-        except pexpect.EOF:
+        # Block until a prompt, or until ssh forks into the background and
+        # the pty is closed: no polling
+        i = tunnel.expect([ssh_newkey, '[Pp]assword:', pexpect.EOF],
+                          timeout=None)
+        if i==0:
+            os.remove(errors)
+            raise SSHException('The authenticity of the host can\'t be established.')
+        elif i==2:
+            tunnel.close()
+            with open(errors) as f:
+                output = f.read()
+            os.remove(errors)
             if tunnel.exitstatus:
                 print(tunnel.exitstatus)
-                print(tunnel.before)
-                print(tunnel.after)
+                print(output)
                 raise RuntimeError("tunnel '%s' failed to start"%(cmd))
             else:
                 return tunnel.pid
@@ -258,6 +424,13 @@ def openssh_tunnel(lport, rport, server, remoteip='127.0.0.1', keyfile=None, pas
             tunnel.sendline(password)
             failed = True
     
+def _release_socket(lport):
+    """Return the port number of lport, closing it if it is a socket."""
+    if isinstance(lport, socket.socket):
+        sock, lport = lport, lport.getsockname()[1]
+        sock.close()
+    return lport
+
 def _stop_tunnel(cmd):
     pexpect.run(cmd)
 
@@ -312,60 +485,236 @@ def paramiko_tunnel(lport, rport, server, remoteip='127.0.0.1', keyfile=None, pa
         The time (in seconds) after which no activity will result in the tunnel
         closing.  This prevents orphaned tunnels from running forever.
     
+    """
+    return paramiko_multi_tunnel([(lport, rport)], server, remoteip=remoteip,
+                                 keyfile=keyfile, password=password,
+                                 timeout=timeout)
+
+def paramiko_multi_tunnel(port_pairs, server, remoteip='127.0.0.1', keyfile=None, password=None, timeout=60,
+                          keepalive_interval=KEEPALIVE_INTERVAL,
+                          keepalive_count_max=KEEPALIVE_COUNT_MAX,
+                          reconnect_delay_max=RECONNECT_DELAY_MAX,
+                          ciphers=None, macs=None, compression=None,
+                          port_names=None, stats_path=None,
+                          stats_interval=5, stats_labels=None):
+    """launch a multiplexed tunnel with paramiko in a subprocess.
+    
+    This is `paramiko_tunnel` for several ports at once: a single ssh
+    connection to `server` is made, and every local port is forwarded as
+    its own 'direct-tcpip' channel over that connection. This replaces one
+    process and one ssh handshake per port with one of each per server.
+    
+    If you are familiar with ssh tunnels, this creates the tunnel:
+    
+    ssh server -L localhost:lport1:remoteip:rport1 -L localhost:lport2:remoteip:rport2 ...
+    
+    Parameters
+    ----------
+    
+    port_pairs : list of (int, int)
+        (lport, rport) pairs: the local port for connecting to the tunnel
+        from this machine and the port on the remote machine to connect to.
+        lport may also be a listening socket on 127.0.0.1, e.g. from
+        `rk.ssh.ports.allocate`; it is closed in this process.
+    server : str
+        The ssh server to connect to. The full ssh server string will be parsed.
+        user@server:port
+    remoteip : str [Default: 127.0.0.1]
+        The remote ip, specifying the destination of every tunneled port.
+    keyfile : str; path to public key file
+        This specifies a key to be used in ssh login, default None.
+        Regular default ssh keys will be used without specifying this argument.
+    password : str; 
+        Your ssh password to the ssh server. Note that if this is left None,
+        you will be prompted for it if passwordless key based login is unavailable.
+    timeout : int [default: 60]
+        The time (in seconds) after which no activity will result in the tunnel
+        closing.  This prevents orphaned tunnels from running forever.
+    keepalive_interval : int [default: 5]
+        Seconds between keepalive requests; 0 disables keepalives.
+    keepalive_count_max : int [default: 3]
+        Keepalive requests without a reply after which the connection is
+        considered dead. A dead connection (keepalives or a socket error) is
+        reconnected, and the local ports stay bound meanwhile.
+    reconnect_delay_max : int [default: 30]
+        The longest wait (in seconds) between reconnect attempts.
+    ciphers, macs : list of str
+        The ciphers and MACs to allow; names paramiko does not support are
+        skipped, and paramiko keeps its own order of preference.
+    compression : bool
+        Whether to compress the connection (zlib).
+    port_names : list of str
+        A name for every port pair, e.g. "iopub", to label its stats.
+    stats_path : str
+        Write traffic and latency stats of every port to this file, in the
+        Prometheus text format, every `stats_interval` seconds (see
+        `rk.ssh.stats`), with the extra `stats_labels` dict of labels.
+    
     """
     if paramiko is None:
         raise ImportError("Paramiko not available")
+    # Fail here, not in the tunnel process, if no algorithm is supported
+    _algorithm_options(ciphers, macs, compression)
     
     if password is None:
-        if not _try_passwordless_paramiko(server, keyfile):
+        if not try_passwordless_ssh(server, keyfile, paramiko=True):
             password = getpass("%s's password: "%(server))
 
+    port_pairs = list(port_pairs)
     p = Process(target=_paramiko_tunnel, 
-            args=(lport, rport, server, remoteip), 
-            kwargs=dict(keyfile=keyfile, password=password))
+            args=(port_pairs, server, remoteip), 
+            kwargs=dict(keyfile=keyfile, password=password,
+                        keepalive_interval=keepalive_interval,
+                        keepalive_count_max=keepalive_count_max,
+                        reconnect_delay_max=reconnect_delay_max,
+                        ciphers=ciphers, macs=macs, compression=compression,
+                        port_names=port_names, stats_path=stats_path,
+                        stats_interval=stats_interval,
+                        stats_labels=stats_labels))
     p.daemon=False
     p.start()
     atexit.register(_shutdown_process, p)
+    # The tunnel process has its own copies of the listening sockets
+    for lport, rport in port_pairs:
+        if isinstance(lport, socket.socket):
+            lport.close()
     return p
     
 def _shutdown_process(p):
     if p.is_alive():
         p.terminate()
 
-def _paramiko_tunnel(lport, rport, server, remoteip, keyfile=None, password=None):
+def _algorithm_options(ciphers=None, macs=None, compression=None):
+    """Return SSHClient.connect keyword arguments allowing only `ciphers`
+    and `macs`, and turning compression on or off.
+    """
+    options = {}
+    disabled = {}
+    for kind, names, supported in (
+            ("ciphers", ciphers, paramiko.Transport._preferred_ciphers),
+            ("macs", macs, paramiko.Transport._preferred_macs)):
+        if not names:
+            continue
+        allowed = [name for name in names if name in supported]
+        if not allowed:
+            raise ValueError("no %s supported by paramiko in: %s" %
+                             (kind, ",".join(names)))
+        disabled[kind] = [name for name in supported if name not in allowed]
+    if disabled:
+        options["disabled_algorithms"] = disabled
+    if compression is not None:
+        options["compress"] = compression
+    return options
+
+def _keepalive(transport, interval, count_max):
+    """Send a keepalive request every `interval` seconds, and close
+    `transport` once `count_max` intervals in a row pass without a reply.
+    """
+    requests = queue.Queue()
+    replies = queue.Queue()
+    def requester():
+        # One request at a time, from one thread: global_request has no
+        # timeout
+        while requests.get():
+            # The server answers, if only with a failure, while it is there
+            transport.global_request("keepalive@openssh.com", wait=True)
+            replies.put(True)
+    t = threading.Thread(target=requester)
+    t.daemon = True
+    t.start()
+    missed = 0
+    waiting = False # For the reply to the last request
+    try:
+        while transport.is_active():
+            if not waiting:
+                requests.put(True)
+                waiting = True
+            try:
+                replies.get(timeout=interval)
+            except queue.Empty:
+                missed += 1
+                if missed >= count_max:
+                    transport.close()
+                    return
+                continue
+            waiting = False
+            missed = 0
+            time.sleep(interval)
+    finally:
+        requests.put(False)
+
+def _paramiko_tunnel(port_pairs, server, remoteip, keyfile=None, password=None,
+                     keepalive_interval=KEEPALIVE_INTERVAL,
+                     keepalive_count_max=KEEPALIVE_COUNT_MAX,
+                     reconnect_delay_max=RECONNECT_DELAY_MAX,
+                     ciphers=None, macs=None, compression=None,
+                     port_names=None, stats_path=None, stats_interval=5,
+                     stats_labels=None):
     """Function for actually starting a paramiko tunnel, to be passed
     to multiprocessing.Process(target=this), and not called directly.
+
+    The local ports are bound once, and served over one connection after
+    another: a dead connection is reconnected at once, and then with
+    exponential backoff.
     """
     username, server, port = _split_server(server)
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    #client.set_missing_host_key_policy(paramiko.WarningPolicy())
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    try:
-        client.connect(server, port, username=username, key_filename=keyfile,
-                       look_for_keys=True, password=password)
-#    except paramiko.AuthenticationException:
-#        if password is None:
-#            password = getpass("%s@%s's password: "%(username, server))
-#            client.connect(server, port, username=username, password=password)
-#        else:
-#            raise
-    except Exception as e:
-        print('*** Failed to connect to %s:%d: %r' % (server, port, e))
-        sys.exit(1)
+    options = _algorithm_options(ciphers, macs, compression)
+    forwarder = Forwarder(stats_path=stats_path, stats_interval=stats_interval,
+                          stats_labels=stats_labels)
+    port_names = port_names or [None] * len(port_pairs)
+    for (lport, rport), name in zip(port_pairs, port_names):
+        forwarder.add_listener(lport, remoteip, rport, name)
 
     # Don't let SIGINT kill the tunnel subprocess
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Failed reconnects are reported below, keep paramiko tracebacks off
+    # the terminal
+    logging.getLogger("paramiko").addHandler(logging.NullHandler())
 
-    try:
-        forward_tunnel(lport, remoteip, rport, client.get_transport())
-    except KeyboardInterrupt:
-        print('SIGINT: Port forwarding stopped cleanly')
-        sys.exit(0)
-    except Exception as e:
-        print("Port forwarding stopped uncleanly: %s"%e)
-        sys.exit(255)
+    # A connect to a blackholed route gives up as a dead connection would,
+    # instead of waiting for the TCP timeout of the system
+    timeout = keepalive_interval * keepalive_count_max or None
+    connected = False
+    delay = RECONNECT_DELAY
+    while True:
+        client = _paramiko_client()
+        try:
+            client.connect(server, port, username=username,
+                           key_filename=keyfile, look_for_keys=True,
+                           password=password, timeout=timeout,
+                           banner_timeout=timeout, **options)
+        except Exception as e:
+            client.close()
+            if not connected or isinstance(e,
+                                           paramiko.AuthenticationException):
+                print('*** Failed to connect to %s:%d: %r' % (server, port, e))
+                sys.exit(1)
+            print('*** Failed to reconnect to %s:%d: %r, retrying in %gs' %
+                  (server, port, e, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, reconnect_delay_max)
+            continue
+        if connected:
+            print('*** Reconnected to %s:%d' % (server, port))
+        connected = True
+        delay = RECONNECT_DELAY
+        transport = client.get_transport()
+        if keepalive_interval > 0:
+            t = threading.Thread(target=_keepalive, args=(transport,
+                                 keepalive_interval, keepalive_count_max))
+            t.daemon = True
+            t.start()
+        forwarder.ssh_transport = transport
+        try:
+            forwarder.serve_forever()
+        except KeyboardInterrupt:
+            print('SIGINT: Port forwarding stopped cleanly')
+            sys.exit(0)
+        except Exception as e:
+            print("Port forwarding stopped uncleanly: %s"%e)
+            sys.exit(255)
+        client.close()
+        print('*** Connection to %s:%d lost, reconnecting' % (server, port))
 
 if sys.platform == 'win32':
     ssh_tunnel = paramiko_tunnel
@@ -373,6 +722,9 @@ else:
     ssh_tunnel = openssh_tunnel
 
     
-__all__ = ['tunnel_connection', 'ssh_tunnel', 'openssh_tunnel', 'paramiko_tunnel', 'try_passwordless_ssh']
+__all__ = ['tunnel_connection', 'ssh_tunnel', 'openssh_tunnel',
+           'openssh_multi_tunnel', 'paramiko_tunnel', 'map_hosts',
+           'paramiko_multi_tunnel', 'remember_passwordless', 'system_host_keys',
+           'try_passwordless_ssh']
 
 
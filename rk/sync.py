@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental sync of the working directory to a remote machine
+
+Before a kernel starts, the rkscript can copy its working directory to
+the remote machine over the execnet gateway of the kernel, so notebooks
+find their relative data files there. Only changed files are sent:
+
+1. the local side sends the size and SHA-1 of every file of the tree. The
+   hashes come from a local manifest cache and are only computed again
+   for files whose size or mtime changed,
+2. the remote side compares them with its own manifest, next to the
+   copy, and answers with the files it needs. It deletes the files it got
+   from an earlier sync that are gone from the tree. For an unchanged
+   tree the answer is empty, and the sync is this one round trip,
+3. the local side sends the needed files in chunks, without waiting for
+   replies, and the remote side answers once with what it wrote.
+
+Files larger than the file size limit are skipped, and so are the files
+that would push one sync over the total size limit (they are sent by a
+later sync). Directories and files matching an ignore pattern, e.g.
+``.git`` or ``*.pyc``, are left out.
+
+The source of this module is sent to the remote machine, after the one of
+`rk.files`, and the remote machine calls `serve`, so it must only use the
+standard library and `rk.files`.
+
+"""
+
+import hashlib
+import json
+import os
+import stat
+from fnmatch import fnmatch
+
+try:
+    from rk.files import replace_file
+except ImportError: # On the remote machine, sent before this module
+    pass
+
+manifest_name = ".rk-sync.json" # Remote manifest, in the copy
+chunk_size = 1 << 20 # Bytes per channel message
+
+
+def file_digest(path):
+    """Return the SHA-1 hex digest of a file"""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def load_manifest(path):
+    """Return {relative path: [size, mtime, digest]}, or {} if there is no
+    valid manifest at path
+
+    """
+
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    return manifest
+
+def save_manifest(path, manifest):
+    """Replace the manifest at path"""
+
+    replace_file(path, json.dumps(manifest, sort_keys=True))
+
+def is_ignored(name, rel_path, ignore):
+    """Whether a file or directory matches an ignore pattern, by its name
+    or by its path relative to the root
+
+    """
+
+    for pattern in ignore:
+        if fnmatch(name, pattern) or fnmatch(rel_path, pattern):
+            return True
+    return False
+
+def scan(root, ignore=(), max_file_size=None):
+    """Walk root, return ({relative path: [size, mtime]}, [relative paths of
+    the files over max_file_size bytes])
+
+    """
+
+    ignore = list(ignore) + [manifest_name]
+    files = {}
+    skipped = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        rel_dir = os.path.relpath(dir_path, root)
+        rel_dir = "" if rel_dir == os.curdir else rel_dir + '/'
+        # Prune ignored directories, in place
+        dir_names[:] = [name for name in sorted(dir_names)
+                        if not is_ignored(name, rel_dir + name, ignore)]
+        for name in file_names:
+            rel_path = rel_dir + name
+            if is_ignored(name, rel_path, ignore):
+                continue
+            try:
+                st = os.stat(os.path.join(dir_path, name))
+            except OSError:
+                continue # Deleted meanwhile, or a broken link
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if max_file_size != None and st.st_size > max_file_size:
+                skipped.append(rel_path)
+                continue
+            files[rel_path] = [st.st_size, st.st_mtime]
+    return files, skipped
+
+def local_manifest(root, ignore=(), max_file_size=None, cache_path=None):
+    """Return ({relative path: [size, mtime, digest]}, skipped files) of
+    the tree at root. Digests are taken from the manifest cache at
+    cache_path, for files of the same size and mtime, and the cache is
+    updated.
+
+    """
+
+    files, skipped = scan(root, ignore, max_file_size)
+    cache = load_manifest(cache_path) if cache_path else {}
+    manifest = {}
+    for rel_path, (size, mtime) in files.items():
+        cached = cache.get(rel_path)
+        if cached != None and cached[:2] == [size, mtime]:
+            manifest[rel_path] = cached
+            continue
+        try:
+            digest = file_digest(os.path.join(root, rel_path))
+        except (IOError, OSError):
+            continue # Deleted or unreadable meanwhile
+        manifest[rel_path] = [size, mtime, digest]
+    if cache_path and manifest != cache:
+        try:
+            save_manifest(cache_path, manifest)
+        except (IOError, OSError):
+            pass # Only a cache
+    return manifest, skipped
+
+def remote_root(root, remote_location):
+    """Return where the tree at root is copied on the remote machine, e.g.
+    "~/.cache/rk/sync/home/albert/notebooks" for "/home/albert/notebooks"
+
+    """
+
+    return remote_location.rstrip('/') + '/' + root.strip('/')
+
+def sync_tree(gateway, root, remote_location, ignore=(), max_file_size=None,
+              max_size=None, cache_path=None):
+    """Sync the tree at root to the remote machine of an execnet gateway.
+    Return a report: the absolute path of the copy ("root"), the files
+    sent ("sent", "sent_bytes"), the unchanged ones ("unchanged"), the
+    remote files deleted ("removed") and the files skipped for the size
+    limits ("skipped").
+
+    max_file_size and max_size are in bytes, None for no limit.
+
+    """
+
+    from inspect import getsource
+    import sys
+
+    from rk import files
+
+    manifest, skipped = local_manifest(root, ignore, max_file_size,
+                                       cache_path)
+    channel = gateway.remote_exec(getsource(files) +
+                                  getsource(sys.modules[__name__]) +
+                                  "\nserve(channel)\n")
+    try:
+        channel.send({"root": remote_root(root, remote_location),
+                      "files": dict((k, [v[0], v[2]])
+                                    for k,v in manifest.items())})
+        reply = channel.receive()
+        report = {"root": reply["root"], "sent": 0, "sent_bytes": 0,
+                  "unchanged": len(manifest) - len(reply["needed"]),
+                  "removed": reply["removed"], "skipped": skipped}
+        if not reply["needed"]:
+            return report
+        for rel_path in sorted(reply["needed"]):
+            size = manifest[rel_path][0]
+            if max_size != None and report["sent_bytes"] + size > max_size:
+                report["skipped"].append(rel_path)
+                continue
+            path = os.path.join(root, rel_path)
+            try:
+                with open(path, 'rb') as f:
+                    while True:
+                        data = f.read(chunk_size)
+                        if not data:
+                            break
+                        channel.send(("chunk", rel_path, data))
+            except (IOError, OSError):
+                channel.send(("abort", rel_path, None))
+                continue
+            channel.send(("file", rel_path, os.stat(path).st_mode & 0o777))
+            report["sent"] += 1
+            report["sent_bytes"] += size
+        channel.send(None)
+        channel.receive() # Written
+        return report
+    finally:
+        channel.waitclose() # The remote manifest is saved
+
+def _target(root, rel_path):
+    """Return the absolute path of rel_path in root, or None if it is not
+    in root
+
+    """
+
+    path = os.path.normpath(os.path.join(root, rel_path))
+    if not path.startswith(root + os.sep):
+        return None
+    return path
+
+def _makedirs(location):
+    """Make a directory and its parents, unless they exist"""
+
+    try:
+        os.makedirs(location)
+    except OSError:
+        if not os.path.isdir(location): # Not made by another sync meanwhile
+            raise
+
+def serve(channel):
+    """The remote side of `sync_tree`"""
+
+    request = channel.receive()
+    root = os.path.abspath(os.path.expanduser(request["root"]))
+    _makedirs(root)
+    manifest_path = os.path.join(root, manifest_name)
+    manifest = load_manifest(manifest_path)
+    files = request["files"]
+    needed = []
+    for rel_path, (size, digest) in files.items():
+        path = _target(root, rel_path)
+        if path is None:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            needed.append(rel_path)
+            continue
+        entry = manifest.get(rel_path)
+        if entry == None or entry[:2] != [st.st_size, st.st_mtime]:
+            # Changed on the remote machine, or not synced yet
+            if st.st_size == size and file_digest(path) == digest:
+                manifest[rel_path] = [st.st_size, st.st_mtime, digest]
+            else:
+                needed.append(rel_path)
+        elif entry[2] != digest:
+            needed.append(rel_path)
+    # Delete the synced files that are gone from the tree, but not the
+    # files made on the remote machine, e.g. notebook outputs
+    removed = 0
+    for rel_path in list(manifest):
+        if rel_path in files:
+            continue
+        del manifest[rel_path]
+        path = _target(root, rel_path)
+        if path != None and os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+    channel.send({"root": root, "needed": needed, "removed": removed})
+    if needed:
+        written = 0
+        parts = {} # Relative path: open partial file
+        while True:
+            message = channel.receive()
+            if message is None:
+                break
+            kind, rel_path, value = message
+            path = _target(root, rel_path)
+            if path is None:
+                continue
+            # Of this process: kernels of one tree may sync at once
+            part_path = "%s.rk-part-%s" % (path, os.getpid())
+            if kind == "chunk":
+                if rel_path not in parts:
+                    _makedirs(os.path.dirname(path))
+                    parts[rel_path] = open(part_path, 'wb')
+                parts[rel_path].write(value)
+                continue
+            f = parts.pop(rel_path, None)
+            if kind == "abort":
+                if f != None:
+                    f.close()
+                    os.remove(part_path)
+                continue
+            if f is None: # An empty file
+                _makedirs(os.path.dirname(path))
+                f = open(part_path, 'wb')
+            f.close()
+            os.chmod(part_path, value)
+            os.rename(part_path, path)
+            st = os.stat(path)
+            manifest[rel_path] = [st.st_size, st.st_mtime,
+                                  files[rel_path][1]]
+            written += 1
+        channel.send(written)
+    save_manifest(manifest_path, manifest)
+
+
+__all__ = ['sync_tree', 'local_manifest', 'scan', 'serve']
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""Per-phase timing of a remote jupyter kernel launch"""
+
+import errno
+import os
+from contextlib import contextmanager
+from json import dumps
+from time import time
+
+try:
+    from time import monotonic
+except ImportError: # Python 2
+    monotonic = time
+
+class PhaseTimer(object):
+    """Time named phases with a monotonic clock
+
+    Every record is a dict with the "phase" name, its duration in
+    "seconds" and the fields given to the constructor (host, session...),
+    written as one JSON line per phase.
+
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.fields["timestamp"] = time()
+        self.records = []
+        self.started = monotonic()
+        self.running = {} # Phase name: start time
+
+    def begin(self, name):
+        """Start phase "name" """
+
+        self.running[name] = monotonic()
+
+    def end(self, name):
+        """Finish phase "name" """
+
+        self.add(name, monotonic() - self.running.pop(name))
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as phase "name" """
+
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def add(self, name, seconds):
+        """Add phase measured elsewhere, e.g. on a remote machine"""
+
+        record = dict(self.fields)
+        record["phase"] = name
+        record["seconds"] = round(seconds, 6)
+        self.records.append(record)
+
+    def total(self, name="total"):
+        """Add phase from timer creation until now"""
+
+        self.add(name, monotonic() - self.started)
+
+    def write(self, path, max_size=None):
+        """Append records to a JSON lines file. Its directory is made
+        private to the user. Once the file is over max_size bytes, it is
+        moved to path + ".1", replacing the older records there.
+
+        """
+
+        location = os.path.dirname(path)
+        if location and not os.path.isdir(location):
+            try:
+                os.makedirs(location, 0o700)
+            except OSError as exception:
+                if exception.errno != errno.EEXIST:
+                    raise
+        try:
+            if max_size != None and os.path.getsize(path) > max_size:
+                os.rename(path, path + ".1")
+        except OSError:
+            pass # No file yet
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT |
+                           getattr(os, "O_NOFOLLOW", 0), 0o600)
+        with os.fdopen(fd, 'a') as f:
+            for record in self.records:
+                f.write(dumps(record, sort_keys=True) + '\n')
+        self.records = []
@@ -32,7 +32,8 @@ setup(
     install_requires = [
         "configobj",
         "execnet",
-        "paramiko"
+        "paramiko",
+        "selectors34; python_version < '3.4'"
     ],
     keywords = ["ipython", "jupyter", "remote kernel", "rk", "python2"],
     license = "Public Domain",